@@ -0,0 +1,87 @@
+"""
+Step time of the contrastive loss with hard negatives (`cl_forward` after pooling: similarities,
+hard-negative weights, cross-entropy and backward) over random embeddings, for several global
+batch sizes. The `legacy` rows build the hard-negative weights with the original Python list
+comprehension and host-to-device copy; the `cached` rows use `hard_negative_weights`, e.g.
+
+python benchmark_cl_loss.py --batch_sizes 64 256 1024 4096 --device cuda
+"""
+import argparse
+import json
+import time
+
+import torch
+import torch.nn as nn
+from prettytable import PrettyTable
+
+from simcse.models import Similarity, hard_negative_weights
+
+
+def legacy_weights(cos_sim, z1_z3_cos, z3_weight, device):
+    return torch.tensor(
+        [[0.0] * (cos_sim.size(-1) - z1_z3_cos.size(-1)) + [0.0] * i + [z3_weight] + [0.0] * (z1_z3_cos.size(-1) - i - 1) for i in range(z1_z3_cos.size(-1))]
+    ).to(device)
+
+
+def loss_step(sim, z1, z2, z3, z3_weight, legacy):
+    cos_sim = sim(z1.unsqueeze(1), z2.unsqueeze(0))
+    z1_z3_cos = sim(z1.unsqueeze(1), z3.unsqueeze(0))
+    cos_sim = torch.cat([cos_sim, z1_z3_cos], 1)
+    if legacy:
+        weights = legacy_weights(cos_sim, z1_z3_cos, z3_weight, z1.device)
+    else:
+        weights = hard_negative_weights(z1_z3_cos.size(-1), z3_weight, z1.device)
+    cos_sim = cos_sim + weights
+    labels = torch.arange(cos_sim.size(0), device=z1.device)
+    loss = nn.CrossEntropyLoss()(cos_sim, labels)
+    loss.backward()
+
+
+def time_steps(device, steps, fn):
+    fn()  # warm up (and fill the weight cache)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[64, 256, 1024, 4096],
+                        help="Global batch sizes (after all-gather)")
+    parser.add_argument("--hidden_size", type=int, default=768)
+    parser.add_argument("--temp", type=float, default=0.05)
+    parser.add_argument("--hard_negative_weight", type=float, default=0.0)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--output", type=str, default=None, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    sim = Similarity(temp=args.temp)
+    results = []
+    for batch_size in args.batch_sizes:
+        z1, z2, z3 = [torch.randn(batch_size, args.hidden_size, device=device, requires_grad=True) for _ in range(3)]
+        row = {"batch_size": batch_size}
+        for name, legacy in [("legacy", True), ("cached", False)]:
+            row[name + "_ms"] = 1000 * time_steps(device, args.steps,
+                                                  lambda: loss_step(sim, z1, z2, z3, args.hard_negative_weight, legacy))
+        results.append(row)
+
+    tb = PrettyTable()
+    tb.field_names = ["Batch size", "Legacy (ms/step)", "Cached (ms/step)", "Speedup"]
+    for r in results:
+        tb.add_row([r["batch_size"], "%.2f" % r["legacy_ms"], "%.2f" % r["cached_ms"], "%.1fx" % (r["legacy_ms"] / r["cached_ms"])])
+    print(tb)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Trade-off between early exit (only running the first N transformer layers) and quality:
+for each depth, report STS-B and SICK-R dev Spearman and encoding throughput, measured
+through `CLTrainer.evaluate`. The model is loaded as in `train.py`, e.g.
+
+python benchmark_early_exit.py \
+    --model_name_or_path result/my-unsup-simcse-bert-base-uncased \
+    --pooler_type cls \
+    --mlp_only_train \
+    --output_dir result/early_exit \
+    --layers 4 6 8 10 12
+"""
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import List
+
+from prettytable import PrettyTable
+from transformers import AutoConfig, AutoTokenizer, HfArgumentParser
+
+from simcse.models import RobertaForCL, BertForCL
+from simcse.trainers import CLTrainer
+from train import ModelArguments, OurTrainingArguments
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class BenchmarkArguments:
+    layers: List[int] = field(
+        default_factory=list,
+        metadata={"help": "Truncation depths to evaluate. Default: every depth from 1 to the full model."}
+    )
+
+
+def main():
+    parser = HfArgumentParser((ModelArguments, OurTrainingArguments, BenchmarkArguments))
+    model_args, training_args, benchmark_args = parser.parse_args_into_dataclasses()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    config = AutoConfig.from_pretrained(model_args.model_name_or_path, cache_dir=model_args.cache_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_args.model_name_or_path, cache_dir=model_args.cache_dir,
+                                              use_fast=model_args.use_fast_tokenizer)
+    if 'roberta' in model_args.model_name_or_path:
+        model_class = RobertaForCL
+    elif 'bert' in model_args.model_name_or_path:
+        model_class = BertForCL
+    else:
+        raise NotImplementedError
+    model = model_class.from_pretrained(model_args.model_name_or_path, config=config,
+                                        cache_dir=model_args.cache_dir, model_args=model_args)
+
+    trainer = CLTrainer(model=model, args=training_args, tokenizer=tokenizer)
+    trainer.model_args = model_args
+
+    layers = benchmark_args.layers or list(range(1, config.num_hidden_layers + 1))
+    results = []
+    for num_layers in layers:
+        logger.info("*** Evaluate with %d layers ***" % num_layers)
+        metrics = trainer.evaluate(num_layers=num_layers)
+        results.append({"num_layers": num_layers,
+                        "stsb_spearman": metrics["eval_stsb_spearman"],
+                        "sickr_spearman": metrics["eval_sickr_spearman"],
+                        "sentences_per_second": metrics["eval_sentences_per_second"]})
+
+    tb = PrettyTable()
+    tb.field_names = ["Layers", "STS-B", "SICK-R", "Avg.", "Sentences/s"]
+    for r in results:
+        tb.add_row([r["num_layers"], "%.2f" % (r["stsb_spearman"] * 100), "%.2f" % (r["sickr_spearman"] * 100),
+                    "%.2f" % ((r["stsb_spearman"] + r["sickr_spearman"]) / 2 * 100), "%.1f" % r["sentences_per_second"]])
+    print(tb)
+
+    if trainer.is_world_process_zero():
+        os.makedirs(training_args.output_dir, exist_ok=True)
+        with open(os.path.join(training_args.output_dir, "early_exit_results.json"), "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
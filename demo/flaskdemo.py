@@ -9,30 +9,216 @@ import logging
 import math
 import copy
 import string
+import asyncio
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from tqdm import tqdm
 from time import time
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 from tornado.wsgi import WSGIContainer
 from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
+from tornado.web import Application, FallbackHandler, RequestHandler, StaticFileHandler
 
-from simcse import SimCSE
+from simcse import QueryBatcher, SimCSE
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class Overloaded(Exception):
+    pass
+
+def load_examples(query_path):
+    with open(query_path, 'r') as fp:
+        return [line.strip() for line in fp.readlines()]
+
+def parse_batch_request(body, max_queries):
+    """
+    Read the JSON body of /api/batch: {"queries": [...], "top_k": 5, "threshold": 0.6}.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get('queries'), list):
+        raise ValueError("The request body must be a JSON object with a list of `queries`.")
+    queries = body['queries']
+    if not all(isinstance(query, str) for query in queries):
+        raise ValueError("`queries` must be a list of strings.")
+    if len(queries) > max_queries:
+        raise ValueError("At most %d queries can be sent in one request." % max_queries)
+    try:
+        top_k, threshold = int(body.get('top_k', 5)), float(body.get('threshold', 0.6))
+    except (TypeError, ValueError):
+        raise ValueError("`top_k` must be an integer and `threshold` a number.")
+    if top_k <= 0:
+        raise ValueError("`top_k` must be positive.")
+    return queries, top_k, threshold
+
+def observe_request(embedder, endpoint, seconds):
+    embedder.metrics.observe("simcse_request_seconds", seconds, help="Time to answer a request.", endpoint=endpoint)
+
+def ndjson_lines(queries, results):
+    for query, result in zip(queries, results):
+        ret = [{"sentence": sentence, "score": score} for sentence, score in result]
+        yield json.dumps({"query": query, "ret": ret}) + "\n"
+
+class RequestLimiter(object):
+    """
+    Admission control for the native tornado handlers: at most `max_pending` searches are queued or
+    running at a time, and requests beyond that are turned away (503) instead of piling up.
+    Without a batcher, searches run on a bounded pool of `num_threads` inference threads.
+    """
+    def __init__(self, max_pending, num_threads):
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self.executor = ThreadPoolExecutor(num_threads)
+
+    @contextmanager
+    def admit(self):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded()
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+class SearchHandler(RequestHandler):
+    def initialize(self, embedder, batcher, limiter):
+        self.embedder = embedder
+        self.batcher = batcher
+        self.limiter = limiter
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    async def get(self):
+        query = self.get_argument('query')
+        top_k = int(self.get_argument('topk'))
+        threshold = float(self.get_argument('threshold'))
+        start = time()
+        try:
+            with self.limiter.admit():
+                # the IOLoop only waits here; inference runs on the batcher thread or the executor
+                if self.batcher is not None:
+                    results = await asyncio.wrap_future(self.batcher.submit(query, top_k=top_k, threshold=threshold))
+                else:
+                    results = await IOLoop.current().run_in_executor(
+                        self.limiter.executor, partial(self.embedder.search, query, top_k=top_k, threshold=threshold)
+                    )
+        except Overloaded:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.write({"error": "Too many pending requests, try again later."})
+            return
+        ret = [{"sentence": sentence, "score": score} for sentence, score in results]
+        span = time() - start
+        observe_request(self.embedder, "/api", span)
+        self.write({"ret": ret, "time": "{:.4f}".format(span)})
+
+class BatchSearchHandler(RequestHandler):
+    def initialize(self, embedder, limiter, args):
+        self.embedder = embedder
+        self.limiter = limiter
+        self.args = args
+
+    def set_default_headers(self):
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    async def post(self):
+        start_time = time()
+        try:
+            queries, top_k, threshold = parse_batch_request(json.loads(self.request.body), self.args.max_batch_queries)
+        except ValueError as e:
+            self.set_status(400)
+            self.write({"error": str(e)})
+            return
+        try:
+            with self.limiter.admit():
+                self.set_header("Content-Type", "application/x-ndjson")
+                # search chunk by chunk and flush, so that clients get the first results early
+                for start in range(0, len(queries), self.args.batch_chunk_size):
+                    chunk = queries[start:start + self.args.batch_chunk_size]
+                    results = await IOLoop.current().run_in_executor(
+                        self.limiter.executor, partial(self.embedder.search, chunk, top_k=top_k, threshold=threshold)
+                    )
+                    for line in ndjson_lines(chunk, results):
+                        self.write(line)
+                    await self.flush()
+            observe_request(self.embedder, "/api/batch", time() - start_time)
+        except Overloaded:
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.write({"error": "Too many pending requests, try again later."})
+
+class MetricsHandler(RequestHandler):
+    def initialize(self, embedder, limiter):
+        self.embedder = embedder
+        self.limiter = limiter
+
+    def get(self):
+        metrics = self.embedder.metrics
+        metrics.set_gauge("simcse_pending_requests", self.limiter.pending, help="Searches queued or running.")
+        metrics.set_counter("simcse_rejected_requests_total", self.limiter.rejected, help="Requests answered with 503.")
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.embedder.render_metrics())
+
+class ExamplesHandler(RequestHandler):
+    def initialize(self, examples):
+        self.examples = examples
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(self.examples))
+
+def run_async_server(port, args, embedder, batcher, examples):
+    """
+    Serve the demo with asyncio-native tornado handlers, so that a slow search never blocks
+    the event loop (and the other clients) and overload is answered with 503.
+    """
+    static_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    limiter = RequestLimiter(args.max_pending, args.inference_threads)
+    app = Application([
+        (r"/api", SearchHandler, {"embedder": embedder, "batcher": batcher, "limiter": limiter}),
+        (r"/api/batch", BatchSearchHandler, {"embedder": embedder, "limiter": limiter, "args": args}),
+        (r"/get_examples", ExamplesHandler, {"examples": examples}),
+        (r"/metrics", MetricsHandler, {"embedder": embedder, "limiter": limiter}),
+        (r"/files/(.*)", StaticFileHandler, {"path": os.path.join(static_path, "files")}),
+        (r"/()", StaticFileHandler, {"path": static_path, "default_filename": "index.html"}),
+    ])
+    logger.info(f'Starting async Index server at {args.ip}:{args.port}')
+    app.listen(port)
+    IOLoop.current().start()
+
 def run_simcse_demo(port, args):
+    sentence_path = os.path.join(args.sentences_dir, args.example_sentences)
+    query_path = os.path.join(args.sentences_dir, args.example_query)
+    examples = load_examples(query_path)
+    embedder = SimCSE(args.model_name_or_path, search_cache_size=args.search_cache_size, search_cache_ttl=args.search_cache_ttl,
+                      collect_metrics=True)
+    # reuse a saved index when available instead of re-encoding the corpus on every boot
+    if args.index_path is not None and os.path.exists(os.path.join(args.index_path, "meta.json")):
+        embedder.load_index(args.index_path)
+    else:
+        embedder.build_index(sentence_path)
+        if args.index_path is not None:
+            embedder.save_index(args.index_path)
+    # concurrent queries are coalesced into one batched forward and search
+    batcher = None
+    if args.max_batch_size > 1:
+        batcher = QueryBatcher(embedder, max_batch_size=args.max_batch_size, max_wait_ms=args.batch_wait_ms)
+
+    if args.server == 'async':
+        run_async_server(port, args, embedder, batcher, examples)
+        return
+
     app = Flask(__name__, static_folder='./static')
     app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
     CORS(app)
 
-    sentence_path = os.path.join(args.sentences_dir, args.example_sentences)
-    query_path = os.path.join(args.sentences_dir, args.example_query)
-    embedder = SimCSE(args.model_name_or_path)
-    embedder.build_index(sentence_path)
     @app.route('/')
     def index():
         return app.send_static_file('index.html')
@@ -43,29 +229,48 @@ def run_simcse_demo(port, args):
         top_k = int(request.args['topk'])
         threshold = float(request.args['threshold'])
         start = time()
-        results = embedder.search(query, top_k=top_k, threshold=threshold)
+        if batcher is not None:
+            results = batcher.search(query, top_k=top_k, threshold=threshold)
+        else:
+            results = embedder.search(query, top_k=top_k, threshold=threshold)
         ret = []
         out = {}
         for sentence, score in results:
             ret.append({"sentence": sentence, "score": score})
         span = time() - start
+        observe_request(embedder, "/api", span)
         out['ret'] = ret
         out['time'] = "{:.4f}".format(span)
         return jsonify(out)
 
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(embedder.render_metrics(), mimetype='text/plain; version=0.0.4')
+
     @app.route('/files/<path:path>')
     def static_files(path):
         return app.send_static_file('files/' + path)
         
     @app.route('/get_examples', methods=['GET'])
     def get_examples():
-        with open(query_path, 'r') as fp:
-            examples = [line.strip() for line in fp.readlines()]
         return jsonify(examples)
     
     addr = args.ip + ":" + args.port
     logger.info(f'Starting Index server at {addr}')
-    http_server = HTTPServer(WSGIContainer(app))
+    # requests need to be handled concurrently for the batcher to coalesce them
+    try:
+        container = WSGIContainer(app, executor=ThreadPoolExecutor(args.num_threads))
+    except TypeError:
+        logger.warning("This version of tornado runs WSGI apps on the IOLoop thread only (tornado>=6.3 is needed for "
+                       "an executor), so requests are handled one at a time and are not batched.")
+        container = WSGIContainer(app)
+    # tornado's WSGI container buffers whole responses, so /api/batch is served by the native
+    # (streaming) handler and everything else falls back to the Flask app
+    limiter = RequestLimiter(args.max_pending, args.inference_threads)
+    http_server = HTTPServer(Application([
+        (r"/api/batch", BatchSearchHandler, {"embedder": embedder, "limiter": limiter, "args": args}),
+        (r".*", FallbackHandler, {"fallback": container}),
+    ]))
     http_server.listen(port)
     IOLoop.instance().start()
 
@@ -76,9 +281,20 @@ if __name__=="__main__":
     parser.add_argument('--sentences_dir', default=None, type=str)
     parser.add_argument('--example_query', default=None, type=str)
     parser.add_argument('--example_sentences', default=None, type=str)
+    parser.add_argument('--index_path', default=None, type=str, help="Directory to load the index from (or save it to after building)")
     parser.add_argument('--port', default='8888', type=str)
     parser.add_argument('--ip', default='http://127.0.0.1')
     parser.add_argument('--load_light', default=False, action='store_true')
+    parser.add_argument('--max_batch_size', default=32, type=int, help="Max number of concurrent queries searched together (1 disables batching)")
+    parser.add_argument('--batch_wait_ms', default=5.0, type=float, help="How long a query waits for others to batch with")
+    parser.add_argument('--num_threads', default=32, type=int, help="Number of threads handling requests")
+    parser.add_argument('--server', default='wsgi', choices=['wsgi', 'async'], help="Flask app in tornado's WSGI container, or asyncio-native tornado handlers")
+    parser.add_argument('--max_pending', default=128, type=int, help="Max number of queued or running searches (async mode) or /api/batch requests (wsgi mode) before answering 503")
+    parser.add_argument('--max_batch_queries', default=1024, type=int, help="Max number of queries in one /api/batch request")
+    parser.add_argument('--batch_chunk_size', default=256, type=int, help="Number of /api/batch queries searched together before their results are streamed")
+    parser.add_argument('--search_cache_size', default=10000, type=int, help="Number of query embeddings and search results to cache (0 disables caching)")
+    parser.add_argument('--search_cache_ttl', default=3600, type=float, help="Seconds after which cached query embeddings and results expire")
+    parser.add_argument('--inference_threads', default=1, type=int, help="Number of threads running searches (async mode without batching) or /api/batch requests")
     args = parser.parse_args()
 
     run_simcse_demo(args.port, args)
\ No newline at end of file
@@ -7,6 +7,8 @@ from prettytable import PrettyTable
 import torch
 import transformers
 from transformers import AutoModel, AutoTokenizer
+from simcse.pooling import POOLERS, encode_and_pool
+from simcse.quantize import QUANTIZE_MODES, load_model
 
 # Set up logger
 logging.basicConfig(format='%(asctime)s : %(message)s', level=logging.DEBUG)
@@ -30,7 +32,7 @@ def main():
     parser.add_argument("--model_name_or_path", type=str, 
             help="Transformers' model name or path")
     parser.add_argument("--pooler", type=str, 
-            choices=['cls', 'cls_before_pooler', 'avg', 'avg_top2', 'avg_first_last'], 
+            choices=POOLERS, 
             default='cls', 
             help="Which pooler to use")
     parser.add_argument("--mode", type=str, 
@@ -46,14 +48,31 @@ def main():
                      'MR', 'CR', 'MPQA', 'SUBJ', 'SST2', 'TREC', 'MRPC',
                      'SICKRelatedness', 'STSBenchmark'], 
             help="Tasks to evaluate on. If '--task_set' is specified, this will be overridden")
+    parser.add_argument("--quantize", type=str,
+            choices=QUANTIZE_MODES,
+            default=None,
+            help="Evaluate the model with quantized (dynamic-int8, CPU only) or half precision weights")
+    parser.add_argument("--quantize_check", action='store_true',
+            help="Compare the '--quantize' model against the float one on STS-B dev "
+                 "(Spearman of both and the mean cosine between their embeddings)")
     
     args = parser.parse_args()
     
     # Load transformers' model checkpoint
-    model = AutoModel.from_pretrained(args.model_name_or_path)
     tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = model.to(device)
+    if args.quantize == 'dynamic-int8':
+        device = torch.device("cpu")
+    else:
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    model = load_model(args.model_name_or_path, quantize=args.quantize).to(device)
+
+    if args.quantize_check:
+        if args.quantize is None:
+            parser.error("--quantize_check requires --quantize")
+        float_model = AutoModel.from_pretrained(args.model_name_or_path).to(device)
+        args.task_set = 'na'
+        args.tasks = ['STSBenchmark']
+        args.mode = 'dev'
     
     # Set up the tasks
     if args.task_set == 'sts':
@@ -82,13 +101,7 @@ def main():
     def prepare(params, samples):
         return
     
-    def batcher(params, batch, max_length=None):
-        # Handle rare token encoding issues in the dataset
-        if len(batch) >= 1 and len(batch[0]) >= 1 and isinstance(batch[0][0], bytes):
-            batch = [[word.decode('utf-8') for word in s] for s in batch]
-
-        sentences = [' '.join(s) for s in batch]
-
+    def embed(model, sentences, max_length=None):
         # Tokenization
         if max_length is not None:
             batch = tokenizer.batch_encode_plus(
@@ -109,33 +122,23 @@ def main():
         for k in batch:
             batch[k] = batch[k].to(device)
         
-        # Get raw embeddings
+        # Get raw embeddings (in float32, also for half precision models)
         with torch.no_grad():
-            outputs = model(**batch, output_hidden_states=True, return_dict=True)
-            last_hidden = outputs.last_hidden_state
-            pooler_output = outputs.pooler_output
-            hidden_states = outputs.hidden_states
-
-        # Apply different poolers
-        if args.pooler == 'cls':
-            # There is a linear+activation layer after CLS representation
-            return pooler_output.cpu()
-        elif args.pooler == 'cls_before_pooler':
-            return last_hidden[:, 0].cpu()
-        elif args.pooler == "avg":
-            return ((last_hidden * batch['attention_mask'].unsqueeze(-1)).sum(1) / batch['attention_mask'].sum(-1).unsqueeze(-1)).cpu()
-        elif args.pooler == "avg_first_last":
-            first_hidden = hidden_states[0]
-            last_hidden = hidden_states[-1]
-            pooled_result = ((first_hidden + last_hidden) / 2.0 * batch['attention_mask'].unsqueeze(-1)).sum(1) / batch['attention_mask'].sum(-1).unsqueeze(-1)
-            return pooled_result.cpu()
-        elif args.pooler == "avg_top2":
-            second_last_hidden = hidden_states[-2]
-            last_hidden = hidden_states[-1]
-            pooled_result = ((last_hidden + second_last_hidden) / 2.0 * batch['attention_mask'].unsqueeze(-1)).sum(1) / batch['attention_mask'].sum(-1).unsqueeze(-1)
-            return pooled_result.cpu()
-        else:
-            raise NotImplementedError
+            return encode_and_pool(model, batch, args.pooler).float().cpu()
+
+    cosines = []
+
+    def batcher(params, batch, max_length=None):
+        # Handle rare token encoding issues in the dataset
+        if len(batch) >= 1 and len(batch[0]) >= 1 and isinstance(batch[0][0], bytes):
+            batch = [[word.decode('utf-8') for word in s] for s in batch]
+
+        sentences = [' '.join(s) for s in batch]
+        embeddings = embed(model, sentences, max_length)
+        if args.quantize_check:
+            float_embeddings = embed(float_model, sentences, max_length)
+            cosines.append(torch.nn.functional.cosine_similarity(embeddings, float_embeddings, dim=-1))
+        return embeddings
 
     results = {}
 
@@ -143,6 +146,21 @@ def main():
         se = senteval.engine.SE(params, batcher, prepare)
         result = se.eval(task)
         results[task] = result
+
+    if args.quantize_check:
+        # Evaluate the float model on the same split for reference
+        model = float_model
+        args.quantize_check = False
+        se = senteval.engine.SE(params, batcher, prepare)
+        float_result = se.eval('STSBenchmark')
+
+        print("------ quantize check (%s) ------" % (args.quantize))
+        quantized_score = results['STSBenchmark']['dev']['spearman'][0] * 100
+        float_score = float_result['dev']['spearman'][0] * 100
+        print_table(["STSB float", "STSB %s" % args.quantize, "Diff.", "Mean cos(float, %s)" % args.quantize],
+                    ["%.2f" % float_score, "%.2f" % quantized_score, "%.2f" % (quantized_score - float_score),
+                     "%.4f" % torch.cat(cosines).mean().item()])
+        return
     
     # Print evaluation results
     if args.mode == 'dev':
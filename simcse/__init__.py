@@ -1 +1,3 @@
 from .tool import SimCSE
+from .cache import EmbeddingCache
+from .batching import QueryBatcher
@@ -0,0 +1,80 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+class QueryBatcher(object):
+    """
+    Coalesces concurrent single-query searches. Queries queue up for at most `max_wait_ms`
+    (or until `max_batch_size` of them are waiting), then a background thread runs them
+    through one batched `SimCSE.search` (one encode and one matrix search) and hands each
+    caller its own results.
+    """
+    def __init__(self, embedder, max_batch_size: int = 32, max_wait_ms: float = 5.0):
+        self.embedder = embedder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self._loop, name="simcse-query-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, query: str, top_k: int = 5, threshold: float = 0.6) -> Future:
+        if self.closed:
+            raise RuntimeError("QueryBatcher is closed.")
+        future = Future()
+        self.queue.put((query, top_k, threshold, future))
+        return future
+
+    def search(self, query: str, top_k: int = 5, threshold: float = 0.6, timeout: float = None) -> List[Tuple[str, float]]:
+        return self.submit(query, top_k=top_k, threshold=threshold).result(timeout)
+
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size and batch[-1] is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            stop = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if len(batch) > 0:
+                self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch: list):
+        queries = [item[0] for item in batch]
+        # search once with the loosest settings, then cut each result down to its own request
+        top_k = max(item[1] for item in batch)
+        threshold = min(item[2] for item in batch)
+        try:
+            results = self.embedder.search(queries, top_k=top_k, threshold=threshold)
+        except Exception as e:
+            for item in batch:
+                item[3].set_exception(e)
+            return
+        for (_, item_top_k, item_threshold, future), result in zip(batch, results):
+            future.set_result([(sentence, score) for sentence, score in result[:item_top_k] if score >= item_threshold])
+
+    def close(self):
+        """
+        Stop the background thread once the queries submitted so far are answered.
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+from numpy import ndarray
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingCache(object):
+    """
+    A content-addressed embedding cache with two tiers: an in-memory LRU of at most
+    `max_memory_items` vectors, and an optional on-disk sqlite store under `cache_dir`
+    that persists across processes. Keys are hashes of a namespace (model, pooler,
+    max_length, normalization) and the sentence text.
+    """
+    def __init__(self, cache_dir: str = None, max_memory_items: int = 100000):
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.db = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(cache_dir, "embeddings.sqlite"), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+            self.db.commit()
+            logger.info("Use on-disk embedding cache at %s" % cache_dir)
+
+    @staticmethod
+    def make_key(namespace: str, text: str) -> str:
+        return hashlib.sha1((namespace + "\x00" + text).encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: ndarray):
+        if self.max_memory_items <= 0:
+            return
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> List[Optional[ndarray]]:
+        """
+        Return the cached vector for each key, or None where the key is missing.
+        """
+        with self.lock:
+            results = [None] * len(keys)
+            disk_lookup = {}
+            for i, key in enumerate(keys):
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    results[i] = self.memory[key]
+                else:
+                    disk_lookup.setdefault(key, []).append(i)
+
+            if self.db is not None and len(disk_lookup) > 0:
+                missing_keys = list(disk_lookup)
+                # stay below sqlite's limit on the number of bound variables
+                for start in range(0, len(missing_keys), 500):
+                    part = missing_keys[start:start + 500]
+                    rows = self.db.execute(
+                        "SELECT key, vector FROM embeddings WHERE key IN (%s)" % ",".join("?" * len(part)), part
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype=np.float32)
+                        self._remember(key, vector)
+                        for i in disk_lookup[key]:
+                            results[i] = vector
+
+            num_hits = sum(1 for r in results if r is not None)
+            self.hits += num_hits
+            self.misses += len(keys) - num_hits
+            return results
+
+    def put_many(self, keys: List[str], vectors: ndarray):
+        with self.lock:
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self.db is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in zip(keys, vectors)]
+                )
+                self.db.commit()
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM embeddings")
+                self.db.commit()
+
+
+class LRUCache(object):
+    """
+    A thread-safe in-memory LRU cache of at most `max_items` entries, each of which expires
+    `ttl` seconds after it was stored (never, if `ttl` is None). Counts hits and misses.
+    """
+    def __init__(self, max_items: int, ttl: float = None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self.items[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if self.max_items <= 0:
+            return
+        with self.lock:
+            self.items[key] = (value, time.monotonic())
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.items)}
@@ -0,0 +1,150 @@
+import argparse
+import inspect
+import json
+import logging
+import os
+from typing import Dict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import Tensor
+from transformers import AutoModel, AutoTokenizer
+
+from .pooling import POOLERS, encode_and_pool, truncate_layers
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = {"onnx": "model.onnx", "torchscript": "model.pt"}
+CONFIG_NAME = "export_config.json"
+
+class PooledEncoder(nn.Module):
+    """
+    The encoder followed by the pooler, so that both can be exported as a single graph
+    mapping token ids to sentence embeddings (not normalized).
+    """
+    def __init__(self, model: nn.Module, pooler: str):
+        super().__init__()
+        assert pooler in POOLERS, "unrecognized pooling type %s" % pooler
+        self.model = model
+        self.pooler = pooler
+
+    def forward(self, input_ids: Tensor, attention_mask: Tensor, token_type_ids: Tensor = None) -> Tensor:
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            inputs["token_type_ids"] = token_type_ids
+        return encode_and_pool(self.model, inputs, self.pooler)
+
+
+def export_model(model_name_or_path: str, output_dir: str, pooler: str = "cls", format: str = "onnx", opset_version: int = 14,
+                 num_layers: int = None):
+    """
+    Trace the encoder and `pooler` into `output_dir`, together with the tokenizer and an
+    `export_config.json`, so that `SimCSE(output_dir, backend=format)` can load it.
+    Batch and sequence length are dynamic. With `num_layers`, only the first layers are exported.
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format %s. Choose from %s." % (format, ", ".join(EXPORT_FORMATS)))
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+    model = AutoModel.from_pretrained(model_name_or_path)
+    if num_layers is not None:
+        truncate_layers(model, num_layers)
+    encoder = PooledEncoder(model, pooler).eval()
+    input_names = [name for name in ["input_ids", "attention_mask", "token_type_ids"] if name in tokenizer.model_input_names]
+    example = tokenizer(["An example sentence.", "Another, slightly longer example sentence."], padding=True, return_tensors="pt")
+    example_inputs = tuple(example[name] for name in input_names)
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, EXPORT_FORMATS[format])
+    with torch.no_grad():
+        if format == "torchscript":
+            traced = torch.jit.trace(encoder, example_inputs)
+            torch.jit.save(traced, output_path)
+        else:
+            kwargs = {}
+            if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+                # `dynamic_axes` belongs to the TorchScript-based exporter
+                kwargs["dynamo"] = False
+            dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+            dynamic_axes["embeddings"] = {0: "batch"}
+            torch.onnx.export(encoder, example_inputs, output_path, input_names=input_names, output_names=["embeddings"],
+                              dynamic_axes=dynamic_axes, opset_version=opset_version, **kwargs)
+
+    tokenizer.save_pretrained(output_dir)
+    with open(os.path.join(output_dir, CONFIG_NAME), "w") as f:
+        json.dump({"model_name_or_path": model_name_or_path, "pooler": pooler, "format": format,
+                   "input_names": input_names, "hidden_size": model.config.hidden_size,
+                   "num_layers": model.config.num_hidden_layers}, f, indent=2)
+    logger.info("Exported %s encoder with %s pooler to %s" % (format, pooler, output_path))
+
+
+def is_exported_model(path: str) -> bool:
+    return os.path.exists(os.path.join(path, CONFIG_NAME))
+
+
+class ExportedEncoder(object):
+    """
+    Runs an encoder written by `export_model` with onnxruntime or TorchScript.
+    Called with tokenizer outputs, it returns the pooled sentence embeddings.
+    """
+    def __init__(self, path: str, device: str = "cpu"):
+        with open(os.path.join(path, CONFIG_NAME)) as f:
+            self.config = json.load(f)
+        self.format = self.config["format"]
+        self.pooler = self.config["pooler"]
+        self.input_names = self.config["input_names"]
+        self.hidden_size = self.config["hidden_size"]
+        self.device = device
+
+        model_path = os.path.join(path, EXPORT_FORMATS[self.format])
+        if self.format == "onnx":
+            import onnxruntime
+            providers = ["CPUExecutionProvider"]
+            if device.startswith("cuda"):
+                providers.insert(0, "CUDAExecutionProvider")
+            self.session = onnxruntime.InferenceSession(model_path, providers=providers)
+        else:
+            self.module = torch.jit.load(model_path, map_location=device).eval()
+
+    def to(self, device: str) -> "ExportedEncoder":
+        if self.format == "torchscript" and device != self.device:
+            self.module = self.module.to(device)
+        self.device = device
+        return self
+
+    def __call__(self, inputs: Dict[str, Tensor]) -> Tensor:
+        if self.format == "onnx":
+            feeds = {name: inputs[name].cpu().numpy().astype(np.int64) for name in self.input_names}
+            return torch.from_numpy(self.session.run(["embeddings"], feeds)[0]).to(self.device)
+        return self.module(*[inputs[name].to(self.device) for name in self.input_names])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a SimCSE encoder and pooler to ONNX or TorchScript")
+    parser.add_argument("--model_name_or_path", type=str, required=True,
+            help="Transformers' model name or path")
+    parser.add_argument("--output_dir", type=str, required=True,
+            help="Directory to write the exported model, tokenizer and config to")
+    parser.add_argument("--pooler", type=str,
+            choices=POOLERS,
+            default="cls",
+            help="Which pooler to export with the encoder")
+    parser.add_argument("--format", type=str,
+            choices=list(EXPORT_FORMATS),
+            default="onnx",
+            help="Export format")
+    parser.add_argument("--opset_version", type=int, default=14,
+            help="ONNX opset version")
+    parser.add_argument("--num_layers", type=int, default=None,
+            help="Only export the first N transformer layers (early exit)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
+    export_model(args.model_name_or_path, args.output_dir, pooler=args.pooler, format=args.format,
+                 opset_version=args.opset_version, num_layers=args.num_layers)
+
+
+if __name__ == "__main__":
+    main()
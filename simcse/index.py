@@ -0,0 +1,561 @@
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from .storage import atomic_write
+
+# Supported faiss index types and their tunable parameters (with defaults).
+# `nlist`/`nprobe` default to SimCSE's `num_cells`/`num_cells_in_search`.
+FAISS_INDEX_PARAMS = {
+    "flat": {},
+    "ivf": {"nlist": None, "nprobe": None},
+    "ivf_pq": {"nlist": None, "nprobe": None, "m": None, "nbits": 8},
+    "hnsw": {"hnsw_m": 32, "ef_construction": 40, "ef_search": 16},
+    "sq8": {},
+}
+
+
+def exact_search(query_vecs: ndarray,
+                    embeddings: ndarray,
+                    top_k: int,
+                    max_block_bytes: int = 256 * 1024 * 1024,
+                    valid: ndarray = None) -> Tuple[ndarray, ndarray]:
+    """
+    Exact inner-product top-k search of all queries against `embeddings` at once.
+    The embedding matrix (which may be a float16 memmap) is scanned in row blocks
+    sized so that the (num_queries, block) score matrix stays within `max_block_bytes`,
+    and a running top-k is kept with `argpartition`. Rows where the boolean mask `valid`
+    is False are skipped. Returns (scores, ids) of shape (num_queries, min(top_k, num_embeddings))
+    sorted by descending score, like faiss; missing results have id -1.
+    """
+    query_vecs = np.asarray(query_vecs, dtype=np.float32)
+    num_queries, num_embeddings = query_vecs.shape[0], embeddings.shape[0]
+    k = min(top_k, num_embeddings)
+    scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+    ids = np.full((num_queries, k), -1, dtype=np.int64)
+    if k <= 0 or num_queries == 0:
+        return scores, ids
+
+    block_size = max(k, max_block_bytes // (4 * num_queries))
+    for start in range(0, num_embeddings, block_size):
+        block = np.asarray(embeddings[start:start + block_size], dtype=np.float32)
+        block_scores = query_vecs @ block.T
+        if valid is not None:
+            block_scores[:, ~valid[start:start + block_size]] = -np.inf
+        if block_scores.shape[1] > k:
+            block_ids = np.argpartition(-block_scores, k - 1, axis=1)[:, :k]
+            block_scores = np.take_along_axis(block_scores, block_ids, axis=1)
+        else:
+            block_ids = np.broadcast_to(np.arange(block_scores.shape[1]), block_scores.shape)
+
+        # merge the block's candidates into the running top-k
+        candidate_scores = np.concatenate([scores, block_scores], axis=1)
+        candidate_ids = np.concatenate([ids, block_ids + start], axis=1)
+        top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(candidate_scores, top, axis=1)
+        ids = np.take_along_axis(candidate_ids, top, axis=1)
+
+    order = np.argsort(-scores, axis=1, kind="stable")
+    scores, ids = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    if valid is not None:
+        ids[np.isneginf(scores)] = -1
+    return scores, ids
+
+
+class EmbeddingStore(object):
+    """
+    A growable embedding matrix for the brute-force index. Appends go into a buffer whose
+    capacity doubles when full, so many small `add` calls cost amortised O(1) copies per row
+    instead of re-concatenating the whole matrix. Rows are addressed by their position: they
+    can be overwritten in place with `update` and tombstoned with `delete`, and searches skip
+    tombstoned rows.
+    """
+    def __init__(self, dim: int, dtype=np.float32, capacity: int = 0):
+        self.data = np.empty((capacity, dim), dtype=dtype)
+        self.deleted = np.zeros(capacity, dtype=bool)
+        self.size = 0
+        self.num_deleted = 0
+        # False when `data` is a caller's array or a read-only memmap, which is copied before any write
+        self.owned = True
+
+    @classmethod
+    def wrap(cls, embeddings: ndarray, deleted: ndarray = None) -> "EmbeddingStore":
+        """
+        Use an existing matrix (e.g. a memmap) without copying it until the store is modified.
+        """
+        store = cls(embeddings.shape[1], dtype=embeddings.dtype)
+        store.data = embeddings
+        store.size = len(embeddings)
+        store.deleted = np.zeros(len(embeddings), dtype=bool) if deleted is None else np.array(deleted, dtype=bool)
+        store.num_deleted = int(store.deleted.sum())
+        store.owned = False
+        return store
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (self.size, self.data.shape[1])
+
+    @property
+    def vectors(self) -> ndarray:
+        return self.data[:self.size]
+
+    @property
+    def valid(self) -> ndarray:
+        """
+        Boolean mask of live rows, or None when no row is deleted.
+        """
+        return None if self.num_deleted == 0 else ~self.deleted[:self.size]
+
+    def _reserve(self, capacity: int):
+        if self.owned and capacity <= len(self.data):
+            return
+        new_capacity = max(capacity, 2 * len(self.data), 1024) if capacity > len(self.data) else capacity
+        data = np.empty((new_capacity, self.data.shape[1]), dtype=self.data.dtype)
+        data[:self.size] = self.data[:self.size]
+        deleted = np.zeros(new_capacity, dtype=bool)
+        deleted[:self.size] = self.deleted[:self.size]
+        self.data, self.deleted, self.owned = data, deleted, True
+
+    def _check_rows(self, rows) -> ndarray:
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        if len(rows) > 0 and (rows.min() < 0 or rows.max() >= self.size):
+            raise IndexError("Row ids should be in [0, %d)." % self.size)
+        if self.num_deleted > 0 and self.deleted[rows].any():
+            raise KeyError("Rows %s have been deleted." % rows[self.deleted[rows]].tolist())
+        return rows
+
+    def add(self, x: ndarray) -> ndarray:
+        """
+        Append rows and return their ids.
+        """
+        self._reserve(self.size + len(x))
+        self.data[self.size:self.size + len(x)] = x
+        rows = np.arange(self.size, self.size + len(x), dtype=np.int64)
+        self.size += len(x)
+        return rows
+
+    def update(self, rows, x: ndarray):
+        rows = self._check_rows(rows)
+        self._reserve(self.size)
+        self.data[rows] = x
+
+    def delete(self, rows):
+        rows = self._check_rows(rows)
+        self._reserve(self.size)
+        self.deleted[rows] = True
+        self.num_deleted = int(self.deleted[:self.size].sum())
+
+    def compact(self) -> ndarray:
+        """
+        Drop tombstoned rows and return the old ids of the rows that were kept, in order.
+        """
+        kept = np.flatnonzero(~self.deleted[:self.size])
+        data = np.empty((max(len(kept), 1024), self.data.shape[1]), dtype=self.data.dtype)
+        data[:len(kept)] = self.data[kept]
+        self.data, self.deleted, self.owned = data, np.zeros(len(data), dtype=bool), True
+        self.size, self.num_deleted = len(kept), 0
+        return kept
+
+
+def resolve_faiss_params(index_type: str, dim: int, index_params: Dict = None) -> Dict:
+    """
+    Validate `index_params` for `index_type` and fill in the defaults.
+    """
+    if index_type not in FAISS_INDEX_PARAMS:
+        raise ValueError("Unknown index type %s. Choose from %s." % (index_type, ", ".join(FAISS_INDEX_PARAMS)))
+    index_params = dict(index_params or {})
+    unknown = set(index_params) - set(FAISS_INDEX_PARAMS[index_type])
+    if len(unknown) > 0:
+        raise ValueError("Unknown parameters for index type %s: %s. Supported: %s." % (
+            index_type, ", ".join(sorted(unknown)), ", ".join(FAISS_INDEX_PARAMS[index_type]) or "none"))
+
+    params = dict(FAISS_INDEX_PARAMS[index_type])
+    params.update(index_params)
+    if index_type == "ivf_pq" and params["m"] is None:
+        # 16 dimensions per sub-quantizer by default (48 bytes per vector for a base model)
+        params["m"] = max(1, dim // 16)
+
+    for name, value in params.items():
+        if value is not None and (not isinstance(value, int) or value <= 0):
+            raise ValueError("`%s` should be a positive integer, got %s." % (name, value))
+    if index_type == "ivf_pq":
+        if dim % params["m"] != 0:
+            raise ValueError("The embedding dimension (%d) must be divisible by `m` (%d)." % (dim, params["m"]))
+        if params["nbits"] > 16:
+            raise ValueError("`nbits` should be at most 16, got %d." % params["nbits"])
+    return params
+
+
+def build_faiss_index(index_type: str, dim: int, params: Dict):
+    """
+    Create an untrained inner-product faiss index of `index_type` with parameters
+    resolved by `resolve_faiss_params`.
+    """
+    import faiss
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+    elif index_type == "ivf":
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFFlat(quantizer, dim, params["nlist"], faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf_pq":
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFPQ(quantizer, dim, params["nlist"], params["m"], params["nbits"], faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+    elif index_type == "sq8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        raise NotImplementedError
+
+
+def is_faiss_gpu_index(index) -> bool:
+    """
+    Whether a faiss index, or the index wrapped by an `IndexIDMap`, lives on GPU.
+    """
+    import faiss
+    while index is not None:
+        if "Gpu" in type(index).__name__:
+            return True
+        index = faiss.downcast_index(index.index) if hasattr(index, "id_map") else None
+    return False
+
+
+def make_faiss_index_writable(index) -> bool:
+    """
+    Copy the inverted lists of an IVF index read with `faiss.IO_FLAG_MMAP` (read-only
+    `OnDiskInvertedLists`) into memory, so that vectors can be added or removed. Returns
+    whether anything was copied.
+    """
+    import faiss
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return False
+    invlists = faiss.downcast_InvertedLists(ivf.invlists)
+    if not isinstance(invlists, faiss.OnDiskInvertedLists) or not invlists.read_only:
+        return False
+    in_memory = faiss.ArrayInvertedLists(invlists.nlist, invlists.code_size)
+    for cell in range(invlists.nlist):
+        size = invlists.list_size(cell)
+        if size > 0:
+            in_memory.add_entries(cell, size, invlists.get_ids(cell), invlists.get_codes(cell))
+    ivf.replace_invlists(in_memory, True)
+    in_memory.this.disown()
+    return True
+
+
+def set_faiss_search_params(index, nprobe: int = None, ef_search: int = None):
+    """
+    Set query-time parameters on a (possibly GPU or wrapped) faiss index.
+    """
+    import faiss
+    if nprobe is None and ef_search is None:
+        return
+    parameter_space = faiss.GpuParameterSpace() if is_faiss_gpu_index(index) else faiss.ParameterSpace()
+    if nprobe is not None:
+        parameter_space.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search is not None:
+        parameter_space.set_index_parameter(index, "efSearch", ef_search)
+
+
+def faiss_search_params(index, nprobe: int = None, ef_search: int = None, excluded: ndarray = None):
+    """
+    Query-time parameters for one `index.search(..., params=...)` call, so that concurrent
+    searches with different settings never touch the shared index. Ids in `excluded` are
+    skipped (only for HNSW indexes, which cannot remove vectors). Returns None when none of
+    the parameters apply to the index.
+    """
+    import faiss
+    if not hasattr(faiss, "SearchParametersIVF"):
+        raise RuntimeError("Per-call `nprobe`/`ef_search` need faiss>=1.7.3.")
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if nprobe is not None and hasattr(inner, "nprobe"):
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if hasattr(inner, "hnsw"):
+        kwargs = {}
+        if excluded is not None and len(excluded) > 0:
+            kwargs["sel"] = faiss.IDSelectorNot(faiss.IDSelectorBatch(np.asarray(excluded, dtype=np.int64)))
+        if ef_search is not None or len(kwargs) > 0:
+            # the params replace the index's own efSearch, so it is always passed
+            return faiss.SearchParametersHNSW(efSearch=inner.hnsw.efSearch if ef_search is None else ef_search, **kwargs)
+    return None
+
+
+class IVFIndex(object):
+    """
+    A dependency-free approximate inner-product index, used when faiss is not installed.
+    Vectors are partitioned into `nlist` cells by spherical k-means, and a query only scans
+    the `nprobe` cells whose centroids are closest to it. It follows the faiss contract
+    used by SimCSE: `train`, `add`, `search` returning (scores, ids), `ntotal`, `nprobe`.
+    """
+    def __init__(self, dim: int, nlist: int = 100, nprobe: int = 10, niter: int = 10, seed: int = 1234):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.niter = niter
+        self.seed = seed
+        self.centroids = None
+        self.ntotal = 0
+        # each cell holds a list of (vectors, ids) chunks that are merged lazily on search
+        self.cells = [[] for _ in range(nlist)]
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def _assign(self, x: ndarray) -> ndarray:
+        return exact_search(x, self.centroids, 1)[1][:, 0]
+
+    def train(self, x: ndarray):
+        x = np.asarray(x, dtype=np.float32)
+        if len(x) < self.nlist:
+            raise ValueError("Training an IVF index with %d cells needs at least %d vectors, got %d." % (self.nlist, self.nlist, len(x)))
+        rng = np.random.RandomState(self.seed)
+        centroids = x[rng.choice(len(x), self.nlist, replace=False)].copy()
+        for _ in range(self.niter):
+            self.centroids = centroids
+            assignment = self._assign(x)
+            counts = np.bincount(assignment, minlength=self.nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, x)
+            # re-seed empty cells with random training points
+            empty = counts == 0
+            sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        self.centroids = centroids.astype(np.float32)
+
+    def add(self, x: ndarray, ids: ndarray = None):
+        if not self.is_trained:
+            raise RuntimeError("The index must be trained before adding vectors.")
+        x = np.asarray(x, dtype=np.float32)
+        if ids is None:
+            ids = np.arange(self.ntotal, self.ntotal + len(x), dtype=np.int64)
+        assignment = self._assign(x)
+        for cell in np.unique(assignment):
+            members = assignment == cell
+            self.cells[cell].append((x[members], ids[members]))
+        self.ntotal += len(x)
+
+    def remove_ids(self, ids: ndarray) -> int:
+        ids = np.asarray(ids, dtype=np.int64)
+        num_removed = 0
+        for cell in range(self.nlist):
+            vectors, cell_ids = self._cell(cell)
+            keep = ~np.isin(cell_ids, ids)
+            if not keep.all():
+                num_removed += int((~keep).sum())
+                self.cells[cell] = [(vectors[keep], cell_ids[keep])]
+        self.ntotal -= num_removed
+        return num_removed
+
+    def retrain(self, sample_size: int = 10000, seed: int = None):
+        """
+        Re-run k-means on a random sample of the indexed vectors and re-assign all of them,
+        e.g. after the index has grown well beyond the data it was first trained on.
+        """
+        cell_data = [self._cell(cell) for cell in range(self.nlist)]
+        vectors = np.concatenate([c[0] for c in cell_data])
+        ids = np.concatenate([c[1] for c in cell_data])
+        rng = np.random.RandomState(self.seed if seed is None else seed)
+        sample = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+        self.train(vectors[sample])
+        self.cells = [[] for _ in range(self.nlist)]
+        self.ntotal = 0
+        self.add(vectors, ids)
+
+    def _cell(self, cell: int) -> Tuple[ndarray, ndarray]:
+        chunks = self.cells[cell]
+        if len(chunks) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        if len(chunks) > 1:
+            chunks[:] = [(np.concatenate([c[0] for c in chunks]), np.concatenate([c[1] for c in chunks]))]
+        return chunks[0]
+
+    def search(self, query_vecs: ndarray, top_k: int, nprobe: int = None) -> Tuple[ndarray, ndarray]:
+        """
+        Each probed cell is scored once against all the queries probing it, and its candidates
+        are merged into the queries' running top-k, as `exact_search` does across row blocks.
+        """
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+        probes = exact_search(query_vecs, self.centroids, nprobe)[1]
+
+        scores = np.full((len(query_vecs), top_k), -np.inf, dtype=np.float32)
+        ids = np.full((len(query_vecs), top_k), -1, dtype=np.int64)
+        if top_k <= 0 or len(query_vecs) == 0:
+            return scores, ids
+        # invert the probes into cell -> queries probing it
+        probed_cells = probes.ravel()
+        order = np.argsort(probed_cells, kind="stable")
+        probing_queries = order // probes.shape[1]
+        cells, starts = np.unique(probed_cells[order], return_index=True)
+        for cell, start, end in zip(cells, starts, np.append(starts[1:], len(order))):
+            vectors, vector_ids = self._cell(cell)
+            if len(vector_ids) == 0:
+                continue
+            queries = probing_queries[start:end]
+            cell_scores, positions = exact_search(query_vecs[queries], vectors, top_k)
+            candidate_scores = np.concatenate([scores[queries], cell_scores], axis=1)
+            candidate_ids = np.concatenate([ids[queries], vector_ids[positions]], axis=1)
+            top = np.argpartition(-candidate_scores, top_k - 1, axis=1)[:, :top_k]
+            scores[queries] = np.take_along_axis(candidate_scores, top, axis=1)
+            ids[queries] = np.take_along_axis(candidate_ids, top, axis=1)
+
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def save(self, path: str):
+        """
+        Save to the directory `path` as `.npy` files, with the vectors grouped by cell.
+        """
+        cell_data = [self._cell(cell) for cell in range(self.nlist)]
+        offsets = np.cumsum([0] + [len(c[1]) for c in cell_data]).astype(np.int64)
+        arrays = {
+            "ivf_centroids.npy": self.centroids,
+            "ivf_offsets.npy": offsets,
+            "ivf_vectors.npy": np.concatenate([c[0] for c in cell_data]),
+            "ivf_ids.npy": np.concatenate([c[1] for c in cell_data]),
+        }
+        for name, array in arrays.items():
+            with atomic_write(os.path.join(path, name)) as tmp_path:
+                np.save(tmp_path, array)
+
+    @classmethod
+    def load(cls, path: str, nprobe: int = 10, mmap: bool = True) -> "IVFIndex":
+        mmap_mode = "r" if mmap else None
+        centroids = np.load(os.path.join(path, "ivf_centroids.npy"))
+        offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+        vectors = np.load(os.path.join(path, "ivf_vectors.npy"), mmap_mode=mmap_mode)
+        ids = np.load(os.path.join(path, "ivf_ids.npy"), mmap_mode=mmap_mode)
+
+        index = cls(centroids.shape[1], nlist=len(centroids), nprobe=nprobe)
+        index.centroids = centroids
+        for cell in range(index.nlist):
+            if offsets[cell + 1] > offsets[cell]:
+                index.cells[cell].append((vectors[offsets[cell]:offsets[cell + 1]], ids[offsets[cell]:offsets[cell + 1]]))
+        index.ntotal = int(offsets[-1])
+        return index
+
+
+class IdMap(object):
+    """
+    Maps stable external ids to the internal rows of an index (the positions in its sentence
+    list). Until a custom id is used, ids are the rows themselves and only the set of removed
+    rows is stored; otherwise an explicit row -> id list and id -> row dict are kept. Default
+    ids are then taken from `next_id`, past every integer id handed out so far.
+    """
+    def __init__(self, size: int = 0, ids: List = None, removed: Iterable[int] = None):
+        self.size = size if ids is None else len(ids)
+        self.next_id = self.size
+        self.ids = None
+        self.rows = None
+        self.removed = set(removed or [])
+        if ids is not None:
+            self._materialize(ids)
+
+    @staticmethod
+    def _python_ids(ids: Iterable) -> List:
+        # NumPy scalars (e.g. from `ids=np.arange(n)`) become Python ones, so ids can be saved as JSON
+        return [i.item() if isinstance(i, np.generic) else i for i in ids]
+
+    def _reserve_ids(self, ids: Iterable):
+        int_ids = [int(i) for i in ids if isinstance(i, (int, np.integer)) and not isinstance(i, bool)]
+        self.next_id = max([self.next_id] + [i + 1 for i in int_ids])
+
+    def _materialize(self, ids: List = None):
+        if ids is None:
+            ids = [None if row in self.removed else row for row in range(self.size)]
+        self.ids = self._python_ids(ids)
+        self.rows = {}
+        for row, i in enumerate(self.ids):
+            if i is None:
+                continue
+            if i in self.rows:
+                raise ValueError("Duplicate id %s." % (i,))
+            self.rows[i] = row
+        self.removed = set()
+        self.size = len(self.ids)
+        self._reserve_ids(self.ids)
+
+    def __len__(self) -> int:
+        return self.size - len(self.removed) if self.ids is None else len(self.rows)
+
+    def __contains__(self, i) -> bool:
+        if self.ids is None:
+            return isinstance(i, (int, np.integer)) and 0 <= i < self.size and int(i) not in self.removed
+        return i in self.rows
+
+    def rows_of(self, ids: Iterable) -> ndarray:
+        rows = []
+        for i in ids:
+            if i not in self:
+                raise KeyError("Id %s is not in the index." % (i,))
+            rows.append(int(i) if self.ids is None else self.rows[i])
+        return np.array(rows, dtype=np.int64)
+
+    def id_of(self, row: int):
+        return row if self.ids is None else self.ids[row]
+
+    def dead_rows(self) -> ndarray:
+        if self.ids is None:
+            return np.array(sorted(self.removed), dtype=np.int64)
+        return np.array([row for row, i in enumerate(self.ids) if i is None], dtype=np.int64)
+
+    def live_rows(self) -> ndarray:
+        if self.ids is None:
+            return np.setdiff1d(np.arange(self.size, dtype=np.int64), np.array(sorted(self.removed), dtype=np.int64))
+        return np.array(sorted(self.rows.values()), dtype=np.int64)
+
+    def add(self, num: int, ids: List = None) -> ndarray:
+        """
+        Allocate `num` new rows for `ids` (default: the rows themselves) and return the rows.
+        """
+        rows = np.arange(self.size, self.size + num, dtype=np.int64)
+        if ids is None:
+            if self.ids is not None:
+                # rows and ids diverge once ids are explicit (e.g. after compaction)
+                ids = list(range(self.next_id, self.next_id + num))
+        elif len(ids) != num:
+            raise ValueError("Got %d ids for %d sentences." % (len(ids), num))
+        else:
+            ids = self._python_ids(ids)
+            if self.ids is None and ids != rows.tolist():
+                self._materialize()
+
+        if self.ids is not None:
+            new_ids = set()
+            for i in ids:
+                if i in self.rows or i in new_ids:
+                    raise ValueError("Id %s is already in the index. Use `upsert` to replace it." % (i,))
+                new_ids.add(i)
+            for row, i in zip(rows.tolist(), ids):
+                self.ids.append(i)
+                self.rows[i] = row
+            self._reserve_ids(ids)
+        self.size += num
+        if self.ids is None:
+            self.next_id = self.size
+        return rows
+
+    def remove(self, ids: Iterable) -> ndarray:
+        rows = self.rows_of(ids)
+        for row in rows.tolist():
+            if self.ids is None:
+                self.removed.add(row)
+            else:
+                del self.rows[self.ids[row]]
+                self.ids[row] = None
+        return rows
+
+    def compact(self, kept_rows: ndarray):
+        """
+        Renumber rows after the index dropped every row not in `kept_rows` (in order).
+        """
+        self._materialize([self.id_of(row) for row in kept_rows.tolist()])
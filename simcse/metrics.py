@@ -0,0 +1,115 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import torch
+
+# latency buckets in seconds, from sub-millisecond (cached or tiny batches) to large batches
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram(object):
+    def __init__(self, buckets: Tuple[float] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{%s} %d' % (name, _join_labels(labels, 'le="%g"' % bound), cumulative))
+        lines.append('%s_bucket{%s} %d' % (name, _join_labels(labels, 'le="+Inf"'), self.count))
+        lines.append('%s_sum%s %.9g' % (name, _braced(labels), self.sum))
+        lines.append('%s_count%s %d' % (name, _braced(labels), self.count))
+        return lines
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    return ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+def _join_labels(labels: str, extra: str) -> str:
+    return labels + "," + extra if labels else extra
+
+def _braced(labels: str) -> str:
+    return "{%s}" % labels if labels else ""
+
+
+class Metrics(object):
+    """
+    Prometheus-style metrics: histograms (e.g. the time spent in each stage of `encode` and
+    `search`), gauges and counters, rendered in the Prometheus text exposition format by
+    `render`. With `sync_cuda=True`, stage timers wait for queued CUDA kernels so that GPU
+    time is attributed to the right stage, at the cost of a synchronization per stage.
+    """
+    def __init__(self, sync_cuda: bool = False):
+        self.sync_cuda = sync_cuda
+        self.lock = threading.Lock()
+        self.types = OrderedDict()
+        self.help = {}
+        self.values = OrderedDict()
+
+    def _get(self, name: str, kind: str, help: str, labels: Dict[str, str]):
+        if name not in self.types:
+            self.types[name] = kind
+            self.help[name] = help
+            self.values[name] = OrderedDict()
+        return self.values[name], _format_labels(labels)
+
+    def observe(self, name: str, value: float, help: str = "", **labels):
+        with self.lock:
+            values, key = self._get(name, "histogram", help, labels)
+            if key not in values:
+                values[key] = Histogram()
+            values[key].observe(value)
+
+    def set_gauge(self, name: str, value: float, help: str = "", **labels):
+        with self.lock:
+            values, key = self._get(name, "gauge", help, labels)
+            values[key] = value
+
+    def set_counter(self, name: str, value: float, help: str = "", **labels):
+        with self.lock:
+            values, key = self._get(name, "counter", help, labels)
+            values[key] = value
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the enclosed block as stage `name` of `simcse_stage_seconds`.
+        """
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync_cuda:
+                torch.cuda.synchronize()
+            self.observe("simcse_stage_seconds", time.perf_counter() - start,
+                         help="Time spent in each stage of encode, similarity and search.", stage=name)
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            for name, kind in self.types.items():
+                if self.help[name]:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, kind))
+                for labels, value in self.values[name].items():
+                    if kind == "histogram":
+                        lines.extend(value.render(name, labels))
+                    else:
+                        lines.append("%s%s %.9g" % (name, _braced(labels), value))
+        return "\n".join(lines) + "\n"
@@ -1,3 +1,7 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,6 +13,7 @@ from transformers.models.roberta.modeling_roberta import RobertaPreTrainedModel,
 from transformers.models.bert.modeling_bert import BertPreTrainedModel, BertModel, BertLMPredictionHead
 from transformers.activations import gelu
 from transformers.file_utils import (
+    ModelOutput,
     add_code_sample_docstrings,
     add_start_docstrings,
     add_start_docstrings_to_model_forward,
@@ -16,6 +21,8 @@ from transformers.file_utils import (
 )
 from transformers.modeling_outputs import SequenceClassifierOutput, BaseModelOutputWithPoolingAndCrossAttentions
 
+from .pooling import EXTRA_HIDDEN_STATE, POOLERS, pool, truncated_layers
+
 class MLPLayer(nn.Module):
     """
     Head for getting sentence representations over RoBERTa/BERT's CLS representation.
@@ -43,8 +50,19 @@ class Similarity(nn.Module):
         self.cos = nn.CosineSimilarity(dim=-1)
 
     def forward(self, x, y):
+        # all pairs of (n, 1, hidden) and (1, m, hidden): one matmul of unit vectors instead of
+        # broadcasting, which would materialize an (n, m, hidden) tensor. It runs in fp32 even
+        # under autocast, as cosine_similarity does, since the logits are scaled by 1 / temp
+        if x.dim() == 3 and y.dim() == 3 and x.size(1) == 1 and y.size(0) == 1:
+            with torch.autocast(device_type=x.device.type, enabled=False):
+                return self._pairwise(x.squeeze(1), y.squeeze(0))
         return self.cos(x, y) / self.temp
 
+    def _pairwise(self, x, y):
+        x = F.normalize(x.float(), dim=-1, eps=self.cos.eps)
+        y = F.normalize(y.float(), dim=-1, eps=self.cos.eps)
+        return torch.matmul(x, y.t()) / self.temp
+
 
 class Pooler(nn.Module):
     """
@@ -58,29 +76,112 @@ class Pooler(nn.Module):
     def __init__(self, pooler_type):
         super().__init__()
         self.pooler_type = pooler_type
-        assert self.pooler_type in ["cls", "cls_before_pooler", "avg", "avg_top2", "avg_first_last"], "unrecognized pooling type %s" % self.pooler_type
+        assert self.pooler_type in POOLERS, "unrecognized pooling type %s" % self.pooler_type
 
     def forward(self, attention_mask, outputs):
-        last_hidden = outputs.last_hidden_state
-        pooler_output = outputs.pooler_output
-        hidden_states = outputs.hidden_states
-
-        if self.pooler_type in ['cls_before_pooler', 'cls']:
-            return last_hidden[:, 0]
-        elif self.pooler_type == "avg":
-            return ((last_hidden * attention_mask.unsqueeze(-1)).sum(1) / attention_mask.sum(-1).unsqueeze(-1))
-        elif self.pooler_type == "avg_first_last":
-            first_hidden = hidden_states[0]
-            last_hidden = hidden_states[-1]
-            pooled_result = ((first_hidden + last_hidden) / 2.0 * attention_mask.unsqueeze(-1)).sum(1) / attention_mask.sum(-1).unsqueeze(-1)
-            return pooled_result
-        elif self.pooler_type == "avg_top2":
-            second_last_hidden = hidden_states[-2]
-            last_hidden = hidden_states[-1]
-            pooled_result = ((last_hidden + second_last_hidden) / 2.0 * attention_mask.unsqueeze(-1)).sum(1) / attention_mask.sum(-1).unsqueeze(-1)
-            return pooled_result
+        extra_hidden = None
+        if self.pooler_type in EXTRA_HIDDEN_STATE:
+            extra_hidden = outputs.hidden_states[EXTRA_HIDDEN_STATE[self.pooler_type]]
+        # 'cls' returns the [CLS] representation here; the MLP over it is applied by the caller
+        return pool(self.pooler_type, attention_mask, outputs.last_hidden_state, extra_hidden=extra_hidden)
+
+
+@lru_cache(maxsize=16)
+def hard_negative_weights(batch_size, weight, device):
+    """
+    Logit bias added to [z1·z2 | z1·z3] similarities: `weight` at each sentence's own hard
+    negative, 0 elsewhere. Built on `device` once per (batch size, weight, device) and
+    reused across steps; callers must not modify it in place.
+    """
+    weights = torch.zeros(batch_size, 2 * batch_size, device=device)
+    weights[:, batch_size:].fill_diagonal_(weight)
+    return weights
+
+
+# all-gather output buffers, reused across steps
+_gather_buffers = {}
+
+class GatherLayer(torch.autograd.Function):
+    """
+    All-gather of a tensor from every process, in one collective and into a buffer reused across
+    steps (so the result is only valid until the next call). Gradients only flow back to this
+    process's own slice, as when gathering and then putting the local tensor back in place.
+    """
+    @staticmethod
+    def forward(ctx, x):
+        world_size = dist.get_world_size()
+        key = (world_size, tuple(x.shape), x.dtype, x.device)
+        if key not in _gather_buffers:
+            _gather_buffers[key] = x.new_empty((world_size,) + tuple(x.shape))
+        buffer = _gather_buffers[key]
+        if hasattr(dist, "all_gather_into_tensor") and dist.get_backend() != "gloo":
+            dist.all_gather_into_tensor(buffer, x.contiguous())
+        else:
+            dist.all_gather(list(buffer.unbind(0)), x.contiguous())
+        ctx.rank = dist.get_rank()
+        return buffer.view_as(buffer)
+
+    @staticmethod
+    def backward(ctx, grad):
+        return grad[ctx.rank]
+
+
+class NegativeQueue(object):
+    """
+    FIFO queue of detached `z2` representations from previous training steps, used as extra
+    negatives (as in MoCo). Entries pushed more than `max_age` steps ago are not used, since they
+    come from an older version of the encoder.
+    """
+    def __init__(self, size, max_age=None):
+        self.size = size
+        self.max_age = max_age
+        self.embeddings = None
+        self.steps = None
+        self.ptr = 0
+        self.step = 0
+
+    def negatives(self):
+        if self.embeddings is None:
+            return None
+        valid = self.steps >= 0
+        if self.max_age is not None:
+            # the current step is `self.step + 1`
+            valid &= self.steps > self.step - self.max_age
+        return self.embeddings[valid]
+
+    def push(self, z):
+        z = z.detach().float()[-self.size:]
+        if self.embeddings is None:
+            self.embeddings = z.new_zeros(self.size, z.size(-1))
+            self.steps = torch.full((self.size,), -1, dtype=torch.long, device=z.device)
+        self.step += 1
+        ids = (self.ptr + torch.arange(z.size(0), device=z.device)) % self.size
+        self.embeddings[ids] = z
+        self.steps[ids] = self.step
+        self.ptr = (self.ptr + z.size(0)) % self.size
+
+
+@dataclass
+class CLEmbeddingOutput(ModelOutput):
+    """
+    Output of `cl_forward` with `cl_embeddings=True`: the representations the contrastive loss is
+    computed over, of shape (batch_size, num_sent, hidden_size), and the MLM loss if MLM inputs are given.
+    """
+    embeddings: torch.FloatTensor = None
+    mlm_loss: Optional[torch.FloatTensor] = None
+
+
+def split_outputs(outputs, n):
+    """
+    Split encoder outputs along the batch axis into the first `n` rows and the rest.
+    """
+    first, second = {}, {}
+    for key, value in outputs.items():
+        if isinstance(value, tuple):
+            first[key], second[key] = tuple(v[:n] for v in value), tuple(v[n:] for v in value)
         else:
-            raise NotImplementedError
+            first[key], second[key] = value[:n], value[n:]
+    return type(outputs)(**first), type(outputs)(**second)
 
 
 def cl_init(cls, config):
@@ -92,6 +193,11 @@ def cl_init(cls, config):
     if cls.model_args.pooler_type == "cls":
         cls.mlp = MLPLayer(config)
     cls.sim = Similarity(temp=cls.model_args.temp)
+    # negatives from previous steps, see `cl_loss`
+    if cls.model_args.queue_size > 0:
+        cls.negative_queue = NegativeQueue(cls.model_args.queue_size, max_age=cls.model_args.queue_max_age)
+    else:
+        cls.negative_queue = None
     cls.init_weights()
 
 def cl_forward(cls,
@@ -108,6 +214,7 @@ def cl_forward(cls,
     return_dict=None,
     mlm_input_ids=None,
     mlm_labels=None,
+    cl_embeddings=False,
 ):
     return_dict = return_dict if return_dict is not None else cls.config.use_return_dict
     ori_input_ids = input_ids
@@ -123,21 +230,38 @@ def cl_forward(cls,
     if token_type_ids is not None:
         token_type_ids = token_type_ids.view((-1, token_type_ids.size(-1))) # (bs * num_sent, len)
 
-    # Get raw embeddings
-    outputs = encoder(
-        input_ids,
-        attention_mask=attention_mask,
-        token_type_ids=token_type_ids,
-        position_ids=position_ids,
-        head_mask=head_mask,
-        inputs_embeds=inputs_embeds,
-        output_attentions=output_attentions,
-        output_hidden_states=True if cls.model_args.pooler_type in ['avg_top2', 'avg_first_last'] else False,
-        return_dict=True,
-    )
+    # MLM auxiliary objective in the same encoder call: the MLM view is appended along the batch
+    # axis, and the outputs are split back afterwards. Not for `cl_embeddings`: gradient caching
+    # first encodes without the MLM view and its replay must draw the same dropout masks
+    fuse_mlm = mlm_input_ids is not None and cls.model_args.mlm_fused_forward \
+        and position_ids is None and inputs_embeds is None and not cl_embeddings
+    if fuse_mlm:
+        outputs = encoder(
+            torch.cat([input_ids, mlm_input_ids.view((-1, mlm_input_ids.size(-1)))], 0),
+            attention_mask=torch.cat([attention_mask, attention_mask], 0),
+            token_type_ids=torch.cat([token_type_ids, token_type_ids], 0) if token_type_ids is not None else None,
+            head_mask=head_mask,
+            output_attentions=output_attentions,
+            output_hidden_states=True if cls.model_args.pooler_type in ['avg_top2', 'avg_first_last'] else False,
+            return_dict=True,
+        )
+        outputs, mlm_outputs = split_outputs(outputs, input_ids.size(0))
+    else:
+        # Get raw embeddings
+        outputs = encoder(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=True if cls.model_args.pooler_type in ['avg_top2', 'avg_first_last'] else False,
+            return_dict=True,
+        )
 
     # MLM auxiliary objective
-    if mlm_input_ids is not None:
+    if mlm_input_ids is not None and not fuse_mlm:
         mlm_input_ids = mlm_input_ids.view((-1, mlm_input_ids.size(-1)))
         mlm_outputs = encoder(
             mlm_input_ids,
@@ -160,6 +284,50 @@ def cl_forward(cls,
     if cls.pooler_type == "cls":
         pooler_output = cls.mlp(pooler_output)
 
+    # Calculate loss for MLM
+    masked_lm_loss = None
+    if mlm_outputs is not None and mlm_labels is not None:
+        mlm_labels = mlm_labels.view(-1, mlm_labels.size(-1))
+        if cls.model_args.mlm_masked_only:
+            # only project the masked positions to the vocabulary; the other labels are ignored anyway
+            masked = mlm_labels != -100
+            prediction_scores = cls.lm_head(mlm_outputs.last_hidden_state[masked])
+            masked_lm_loss = nn.CrossEntropyLoss()(prediction_scores, mlm_labels[masked])
+        else:
+            prediction_scores = cls.lm_head(mlm_outputs.last_hidden_state)
+            masked_lm_loss = nn.CrossEntropyLoss()(prediction_scores.view(-1, cls.config.vocab_size), mlm_labels.view(-1))
+
+    # Only the representations, for training that computes the contrastive loss itself (see `CLTrainer.training_step`)
+    if cl_embeddings:
+        return CLEmbeddingOutput(embeddings=pooler_output, mlm_loss=masked_lm_loss)
+
+    loss, cos_sim = cl_loss(cls, pooler_output)
+    if masked_lm_loss is not None:
+        loss = loss + cls.model_args.mlm_weight * masked_lm_loss
+
+    if not return_dict:
+        output = (cos_sim,) + outputs[2:]
+        return ((loss,) + output) if loss is not None else output
+    return SequenceClassifierOutput(
+        loss=loss,
+        logits=cos_sim,
+        hidden_states=outputs.hidden_states,
+        attentions=outputs.attentions,
+    )
+
+
+def cl_loss(cls, pooler_output):
+    """
+    Contrastive loss over representations of shape (batch_size, num_sent, hidden_size), gathered
+    from all processes in distributed training. Returns the loss and the similarity logits.
+    """
+    num_sent = pooler_output.size(1)
+
+    # Gather all embeddings if using distributed training: [z1, z2, (z3)] of every process in
+    # one collective, (bs, num_sent, hidden) -> (bs x N, num_sent, hidden)
+    if dist.is_initialized() and cls.training:
+        pooler_output = GatherLayer.apply(pooler_output).flatten(0, 1)
+
     # Separate representation
     z1, z2 = pooler_output[:,0], pooler_output[:,1]
 
@@ -167,33 +335,6 @@ def cl_forward(cls,
     if num_sent == 3:
         z3 = pooler_output[:, 2]
 
-    # Gather all embeddings if using distributed training
-    if dist.is_initialized() and cls.training:
-        # Gather hard negative
-        if num_sent >= 3:
-            z3_list = [torch.zeros_like(z3) for _ in range(dist.get_world_size())]
-            dist.all_gather(tensor_list=z3_list, tensor=z3.contiguous())
-            z3_list[dist.get_rank()] = z3
-            z3 = torch.cat(z3_list, 0)
-
-        # Dummy vectors for allgather
-        z1_list = [torch.zeros_like(z1) for _ in range(dist.get_world_size())]
-        z2_list = [torch.zeros_like(z2) for _ in range(dist.get_world_size())]
-        # Allgather
-        dist.all_gather(tensor_list=z1_list, tensor=z1.contiguous())
-        dist.all_gather(tensor_list=z2_list, tensor=z2.contiguous())
-
-        # Since allgather results do not have gradients, we replace the
-        # current process's corresponding embeddings with original tensors
-                
-        z1_list[dist.get_rank()] = z1
-        z2_list[dist.get_rank()] = z2
-        # Get full batch embeddings: (bs x N, hidden)
-        z1 = torch.cat(z1_list, 0)
-        z2 = torch.cat(z2_list, 0)
-        
-        
-
     cos_sim = cls.sim(z1.unsqueeze(1), z2.unsqueeze(0))
     # Hard negative
     if num_sent >= 3:
@@ -266,7 +407,7 @@ def cl_forward(cls,
 
         """
 
-    labels = torch.arange(cos_sim.size(0)).long().to(cls.device)
+    labels = torch.arange(cos_sim.size(0), device=cls.device)
     loss_fct = nn.CrossEntropyLoss()
         
     # Calculate loss with hard negatives
@@ -312,9 +453,7 @@ def cl_forward(cls,
         """
  
         # 1_2はweight:0、1_3にweightを設定
-        weights = torch.tensor(
-            [[0.0] * (cos_sim.size(-1) - z1_z3_cos.size(-1)) + [0.0] * i + [z3_weight] + [0.0] * (z1_z3_cos.size(-1) - i - 1) for i in range(z1_z3_cos.size(-1))]
-        ).to(cls.device)
+        weights = hard_negative_weights(z1_z3_cos.size(-1), z3_weight, cls.device)
         cos_sim = cos_sim + weights
         
         """
@@ -371,6 +510,13 @@ def cl_forward(cls,
     """
         
         
+    # Negatives queued from previous steps, then this step's (gathered) z2 joins the queue
+    if cls.negative_queue is not None and cls.training:
+        queued = cls.negative_queue.negatives()
+        if queued is not None and queued.size(0) > 0:
+            cos_sim = torch.cat([cos_sim, cls.sim(z1.unsqueeze(1), queued.to(z1.dtype).unsqueeze(0))], 1)
+        cls.negative_queue.push(z2)
+
     loss = loss_fct(cos_sim, labels)
     
     """
@@ -378,23 +524,7 @@ def cl_forward(cls,
     tensor(0.6263, device='cuda:0', grad_fn=<NllLossBackward0>)
     torch.Size([])
     """
-
-    # Calculate loss for MLM
-    if mlm_outputs is not None and mlm_labels is not None:
-        mlm_labels = mlm_labels.view(-1, mlm_labels.size(-1))
-        prediction_scores = cls.lm_head(mlm_outputs.last_hidden_state)
-        masked_lm_loss = loss_fct(prediction_scores.view(-1, cls.config.vocab_size), mlm_labels.view(-1))
-        loss = loss + cls.model_args.mlm_weight * masked_lm_loss
-
-    if not return_dict:
-        output = (cos_sim,) + outputs[2:]
-        return ((loss,) + output) if loss is not None else output
-    return SequenceClassifierOutput(
-        loss=loss,
-        logits=cos_sim,
-        hidden_states=outputs.hidden_states,
-        attentions=outputs.attentions,
-    )
+    return loss, cos_sim
 
 
 def sentemb_forward(
@@ -410,21 +540,24 @@ def sentemb_forward(
     output_attentions=None,
     output_hidden_states=None,
     return_dict=None,
+    num_layers=None,
 ):
 
     return_dict = return_dict if return_dict is not None else cls.config.use_return_dict
 
-    outputs = encoder(
-        input_ids,
-        attention_mask=attention_mask,
-        token_type_ids=token_type_ids,
-        position_ids=position_ids,
-        head_mask=head_mask,
-        inputs_embeds=inputs_embeds,
-        output_attentions=output_attentions,
-        output_hidden_states=True if cls.pooler_type in ['avg_top2', 'avg_first_last'] else False,
-        return_dict=True,
-    )
+    # Early exit: only run the first `num_layers` layers and pool from them
+    with truncated_layers(encoder, num_layers):
+        outputs = encoder(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=True if cls.pooler_type in ['avg_top2', 'avg_first_last'] else False,
+            return_dict=True,
+        )
 
     pooler_output = cls.pooler(attention_mask, outputs)
     if cls.pooler_type == "cls" and not cls.model_args.mlp_only_train:
@@ -467,6 +600,8 @@ class BertForCL(BertPreTrainedModel):
         sent_emb=False,
         mlm_input_ids=None,
         mlm_labels=None,
+        num_layers=None,
+        cl_embeddings=False,
     ):
         if sent_emb:
             return sentemb_forward(self, self.bert,
@@ -480,6 +615,7 @@ class BertForCL(BertPreTrainedModel):
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
+                num_layers=num_layers,
             )
         else:
             return cl_forward(self, self.bert,
@@ -495,6 +631,7 @@ class BertForCL(BertPreTrainedModel):
                 return_dict=return_dict,
                 mlm_input_ids=mlm_input_ids,
                 mlm_labels=mlm_labels,
+                cl_embeddings=cl_embeddings,
             )
 
 
@@ -526,6 +663,8 @@ class RobertaForCL(RobertaPreTrainedModel):
         sent_emb=False,
         mlm_input_ids=None,
         mlm_labels=None,
+        num_layers=None,
+        cl_embeddings=False,
     ):
         if sent_emb:
             return sentemb_forward(self, self.roberta,
@@ -539,6 +678,7 @@ class RobertaForCL(RobertaPreTrainedModel):
                 output_attentions=output_attentions,
                 output_hidden_states=output_hidden_states,
                 return_dict=return_dict,
+                num_layers=num_layers,
             )
         else:
             return cl_forward(self, self.roberta,
@@ -554,4 +694,5 @@ class RobertaForCL(RobertaPreTrainedModel):
                 return_dict=return_dict,
                 mlm_input_ids=mlm_input_ids,
                 mlm_labels=mlm_labels,
+                cl_embeddings=cl_embeddings,
             )
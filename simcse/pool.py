@@ -0,0 +1,70 @@
+import logging
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import Dict, List
+
+import numpy as np
+import torch
+from torch import Tensor
+
+logger = logging.getLogger(__name__)
+
+# the model held by each worker process, loaded once by `_init_worker`
+_worker_model = None
+
+def _init_worker(model_kwargs: Dict, num_threads: int):
+    global _worker_model
+    from .tool import SimCSE
+    torch.set_num_threads(num_threads)
+    _worker_model = SimCSE(**model_kwargs)
+
+
+def _encode_shard(shm_name: str, shape: tuple, start: int, sentences: List[str], encode_kwargs: Dict) -> int:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        output = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        output[start:start + len(sentences)] = _worker_model._encode_batches(sentences, "cpu", **encode_kwargs).numpy()
+        del output
+    finally:
+        shm.close()
+    return len(sentences)
+
+
+class EncodingPool(object):
+    """
+    A pool of CPU worker processes that each hold their own copy of the model, so encoding
+    scales past the cores a single process's intra-op threads can keep busy. The input is
+    split into shards (several per worker, so that all of them stay busy until the end) and
+    each worker writes its embeddings straight into a shared-memory output array, in order.
+    """
+    def __init__(self, model_kwargs: Dict, num_workers: int, num_threads: int = None):
+        self.num_workers = num_workers
+        if num_threads is None:
+            num_threads = max(1, multiprocessing.cpu_count() // num_workers)
+        # "spawn" since forking a process that has already run torch ops is unsafe
+        self.pool = multiprocessing.get_context("spawn").Pool(
+            num_workers, initializer=_init_worker, initargs=(model_kwargs, num_threads)
+        )
+        logger.info("Started %d encoding workers with %d threads each" % (num_workers, num_threads))
+
+    def encode(self, sentences: List[str], dim: int, batch_size: int = 64, **encode_kwargs) -> Tensor:
+        encode_kwargs["batch_size"] = batch_size
+        shard_size = max(batch_size, math.ceil(len(sentences) / (4 * self.num_workers)))
+        shard_size = math.ceil(shard_size / batch_size) * batch_size
+
+        shape = (len(sentences), dim)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, 4 * len(sentences) * dim))
+        try:
+            tasks = [(shm.name, shape, start, sentences[start:start + shard_size], encode_kwargs)
+                     for start in range(0, len(sentences), shard_size)]
+            self.pool.starmap(_encode_shard, tasks, chunksize=1)
+            embeddings = torch.from_numpy(np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy())
+        finally:
+            shm.close()
+            shm.unlink()
+        return embeddings
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
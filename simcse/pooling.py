@@ -0,0 +1,119 @@
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Dict
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+POOLERS = ["cls", "cls_before_pooler", "avg", "avg_top2", "avg_first_last"]
+
+# besides the last layer, avg_top2 needs hidden_states[-2] and avg_first_last hidden_states[0]
+EXTRA_HIDDEN_STATE = {"avg_top2": -2, "avg_first_last": 0}
+
+def masked_mean(hidden: Tensor, attention_mask: Tensor) -> Tensor:
+    mask = attention_mask.to(hidden.dtype)
+    return torch.bmm(mask.unsqueeze(1), hidden).squeeze(1) / mask.sum(-1, keepdim=True)
+
+
+def pool(pooler: str, attention_mask: Tensor, last_hidden: Tensor,
+         extra_hidden: Tensor = None, pooler_output: Tensor = None) -> Tensor:
+    """
+    Pool token representations into sentence embeddings (see `models.Pooler` for the pooler types).
+    `extra_hidden` is the hidden state selected by `EXTRA_HIDDEN_STATE`. For 'cls', the model's
+    `pooler_output` is returned if given, otherwise the [CLS] representation.
+    """
+    if pooler == "cls" and pooler_output is not None:
+        return pooler_output
+    elif pooler in ["cls", "cls_before_pooler"]:
+        return last_hidden[:, 0]
+    elif pooler == "avg":
+        return masked_mean(last_hidden, attention_mask)
+    elif pooler in ["avg_top2", "avg_first_last"]:
+        return masked_mean((last_hidden + extra_hidden) / 2.0, attention_mask)
+    else:
+        raise NotImplementedError
+
+
+def _extra_hidden_module(model: nn.Module, pooler: str) -> nn.Module:
+    """
+    The module whose output is the extra hidden state `pooler` needs, for BERT/RoBERTa-like models.
+    """
+    if EXTRA_HIDDEN_STATE[pooler] == 0:
+        return getattr(model, "embeddings", None)
+    encoder = getattr(model, "encoder", None)
+    layers = getattr(encoder, "layer", None)
+    return layers[-2] if layers is not None and len(layers) >= 2 else None
+
+
+def encode_and_pool(model: nn.Module, inputs: Dict[str, Tensor], pooler: str,
+                    stage: Callable[[str], ContextManager] = None) -> Tensor:
+    """
+    Run a transformers encoder on tokenized `inputs` and pool its outputs. Rather than asking
+    for all hidden states, the one extra layer 'avg_top2'/'avg_first_last' needs is caught
+    with a forward hook, so the other layers are freed as soon as the next one is computed.
+    `stage`, if given, returns a context manager timing the "forward" and "pool" stages.
+    """
+    if stage is None:
+        stage = lambda name: nullcontext()
+
+    if pooler not in EXTRA_HIDDEN_STATE:
+        with stage("forward"):
+            outputs = model(**inputs, return_dict=True)
+        with stage("pool"):
+            return pool(pooler, inputs["attention_mask"], outputs.last_hidden_state,
+                        pooler_output=outputs.pooler_output if pooler == "cls" else None)
+
+    module = _extra_hidden_module(model, pooler)
+    if module is None:
+        with stage("forward"):
+            outputs = model(**inputs, output_hidden_states=True, return_dict=True)
+        with stage("pool"):
+            return pool(pooler, inputs["attention_mask"], outputs.last_hidden_state,
+                        extra_hidden=outputs.hidden_states[EXTRA_HIDDEN_STATE[pooler]])
+
+    captured = []
+    def hook(module, args, output):
+        captured.append(output[0] if isinstance(output, tuple) else output)
+    handle = module.register_forward_hook(hook)
+    try:
+        with stage("forward"):
+            outputs = model(**inputs, return_dict=True)
+    finally:
+        handle.remove()
+    with stage("pool"):
+        return pool(pooler, inputs["attention_mask"], outputs.last_hidden_state, extra_hidden=captured[-1])
+
+
+def _check_num_layers(model: nn.Module, num_layers: int) -> nn.ModuleList:
+    layers = getattr(getattr(model, "encoder", None), "layer", None)
+    if layers is None:
+        raise ValueError("Layer truncation needs a BERT/RoBERTa-like model with `encoder.layer`.")
+    if not 0 < num_layers <= len(layers):
+        raise ValueError("num_layers must be between 1 and %d, got %d." % (len(layers), num_layers))
+    return layers
+
+
+def truncate_layers(model: nn.Module, num_layers: int) -> nn.Module:
+    """
+    Drop all but the first `num_layers` transformer layers of `model` (early exit), in place.
+    """
+    layers = _check_num_layers(model, num_layers)
+    model.encoder.layer = layers[:num_layers]
+    model.config.num_hidden_layers = num_layers
+    return model
+
+
+@contextmanager
+def truncated_layers(model: nn.Module, num_layers: int = None):
+    """
+    Run only the first `num_layers` transformer layers of `model` inside the block.
+    """
+    if num_layers is None:
+        yield
+        return
+    layers = _check_num_layers(model, num_layers)
+    model.encoder.layer = layers[:num_layers]
+    try:
+        yield
+    finally:
+        model.encoder.layer = layers
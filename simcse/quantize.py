@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import os
+
+import torch
+import torch.nn as nn
+from transformers import AutoModel
+
+logger = logging.getLogger(__name__)
+
+# dynamic-int8: nn.Linear weights stored as int8 and activations quantized on the fly (CPU only)
+# fp16/bf16: all weights cast to half precision
+QUANTIZE_MODES = ["dynamic-int8", "fp16", "bf16"]
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "simcse", "quantized")
+
+
+# weight files whose changes invalidate cached conversions or embeddings (besides config.json);
+# .onnx/.pt are the models written by `simcse.export`
+WEIGHT_SUFFIXES = (".bin", ".safetensors", ".index.json", ".onnx", ".pt")
+
+
+def checkpoint_fingerprint(model_name_or_path: str) -> str:
+    """
+    Names, sizes and mtimes of the config and weight files of a local checkpoint (or of the
+    cached snapshot of a hub model), so that an updated checkpoint gets a new cache entry.
+    """
+    path = model_name_or_path
+    if not os.path.isdir(path):
+        try:
+            from huggingface_hub import snapshot_download
+            path = snapshot_download(model_name_or_path, local_files_only=True)
+        except Exception:
+            # not downloaded yet (or no huggingface_hub): the name is all we have
+            return ""
+    entries = []
+    for name in sorted(os.listdir(path)):
+        if name == "config.json" or name.endswith(WEIGHT_SUFFIXES):
+            stat = os.stat(os.path.join(path, name))
+            entries.append("%s:%d:%d" % (name, stat.st_size, stat.st_mtime_ns))
+    return ",".join(entries)
+
+
+def _cache_path(model_name_or_path: str, quantize: str, cache_dir: str) -> str:
+    if os.path.isdir(model_name_or_path):
+        model_name_or_path = os.path.abspath(model_name_or_path)
+    key = "|".join([model_name_or_path, checkpoint_fingerprint(model_name_or_path), quantize, torch.__version__])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".pt")
+
+
+def load_model(model_name_or_path: str, quantize: str = None, cache_dir: str = None) -> nn.Module:
+    """
+    Load a transformers encoder, optionally converted for faster inference (see `QUANTIZE_MODES`).
+    A dynamic-int8 model is saved to `cache_dir` after its first conversion and loaded from there
+    afterwards, without building the float model.
+    """
+    if quantize is None:
+        return AutoModel.from_pretrained(model_name_or_path)
+    if quantize not in QUANTIZE_MODES:
+        raise ValueError("Unknown quantization mode %s. Choose from %s." % (quantize, ", ".join(QUANTIZE_MODES)))
+
+    if quantize == "fp16":
+        return AutoModel.from_pretrained(model_name_or_path).half()
+    if quantize == "bf16":
+        return AutoModel.from_pretrained(model_name_or_path).to(torch.bfloat16)
+
+    cache_path = _cache_path(model_name_or_path, quantize, cache_dir or DEFAULT_CACHE_DIR)
+    if os.path.exists(cache_path):
+        logger.info("Load %s model from %s" % (quantize, cache_path))
+        try:
+            return torch.load(cache_path, weights_only=False)
+        except TypeError:
+            # torch < 1.13 has no `weights_only`
+            return torch.load(cache_path)
+
+    model = AutoModel.from_pretrained(model_name_or_path)
+    model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # write to a temporary file first so that concurrent loaders never see a partial file
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    torch.save(model, tmp_path)
+    os.replace(tmp_path, cache_path)
+    logger.info("Saved %s model to %s" % (quantize, cache_path))
+    return model
@@ -0,0 +1,125 @@
+import os
+from array import array
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Union
+
+import numpy as np
+
+class SentenceStore(object):
+    """
+    A list of sentences backed by an offset-indexed file: `data_path` holds the
+    UTF-8 bytes of all sentences back to back and `offsets_path` a `.npy` array of
+    N + 1 byte offsets. With `mmap=True` both files are memory-mapped, so processes that
+    load the same index share one page-cached copy. Sentences appended with `+=` or
+    replaced by assignment are kept in memory.
+    """
+    def __init__(self, data_path: str, offsets_path: str, mmap: bool = True):
+        self.offsets = np.load(offsets_path, mmap_mode="r" if mmap else None)
+        if os.path.getsize(data_path) == 0:
+            self.data = b""
+        elif mmap:
+            self.data = np.memmap(data_path, dtype=np.uint8, mode="r")
+        else:
+            with open(data_path, "rb") as f:
+                self.data = f.read()
+        self.appended = []
+        self.replaced = {}
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1 + len(self.appended)
+
+    def __getitem__(self, i: int) -> str:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("sentence index out of range")
+        num_stored = len(self.offsets) - 1
+        if i >= num_stored:
+            return self.appended[i - num_stored]
+        if i in self.replaced:
+            return self.replaced[i]
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __setitem__(self, i: int, sentence: str):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("sentence index out of range")
+        num_stored = len(self.offsets) - 1
+        if i >= num_stored:
+            self.appended[i - num_stored] = sentence
+        else:
+            self.replaced[i] = sentence
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __iadd__(self, sentences: Iterable[str]) -> "SentenceStore":
+        self.appended.extend(sentences)
+        return self
+
+
+class SentenceWriter(object):
+    """
+    Write sentences one at a time in the offset-indexed format read by `SentenceStore`,
+    keeping only their byte offsets in memory. The offsets file is written by `close`.
+    """
+    def __init__(self, data_path: str, offsets_path: str):
+        self.data_path, self.offsets_path = data_path, offsets_path
+        self.file = open(data_path, "wb")
+        self.offsets = array("q", [0])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def write(self, sentence: str):
+        encoded = sentence.encode("utf-8")
+        self.file.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def tee(self, sentences: Iterable[str]) -> Iterator[str]:
+        """
+        Write each sentence as it passes through.
+        """
+        for sentence in sentences:
+            self.write(sentence)
+            yield sentence
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            np.save(self.offsets_path, np.frombuffer(self.offsets, dtype=np.int64))
+
+
+@contextmanager
+def atomic_write(path: str):
+    """
+    Yield a temporary path next to `path` and move it over `path` once the block succeeds,
+    so that readers of the old file (e.g. a memory map of the index being re-saved) keep
+    their old copy instead of seeing it truncated.
+    """
+    directory, name = os.path.split(path)
+    tmp_path = os.path.join(directory, ".tmp-%d-%s" % (os.getpid(), name))
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def save_sentences(sentences: Union[List[str], SentenceStore], data_path: str, offsets_path: str):
+    """
+    Write sentences in the offset-indexed format read by `SentenceStore`.
+    """
+    offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+    with atomic_write(data_path) as tmp_data_path, atomic_write(offsets_path) as tmp_offsets_path:
+        with open(tmp_data_path, "wb") as f:
+            for i, sentence in enumerate(sentences):
+                encoded = sentence.encode("utf-8")
+                f.write(encoded)
+                offsets[i + 1] = offsets[i] + len(encoded)
+        np.save(tmp_offsets_path, offsets)
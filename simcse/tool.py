@@ -1,19 +1,37 @@
+import collections
+import contextlib
+import gzip
+import io
+import itertools
+import json
 import logging
+import os
+import shutil
+import tempfile
 from tqdm import tqdm
 import numpy as np
 from numpy import ndarray
 import torch
 from torch import Tensor, device
 import transformers
-from transformers import AutoModel, AutoTokenizer
+from transformers import AutoTokenizer
+from .cache import EmbeddingCache, LRUCache
+from .export import ExportedEncoder
+from .metrics import Metrics
+from .pool import EncodingPool
+from .pooling import POOLERS, encode_and_pool, truncate_layers
+from .quantize import checkpoint_fingerprint, load_model
+from .index import FAISS_INDEX_PARAMS, EmbeddingStore, IdMap, IVFIndex, build_faiss_index, exact_search, faiss_search_params, is_faiss_gpu_index, make_faiss_index_writable, resolve_faiss_params, set_faiss_search_params
+from .storage import SentenceStore, SentenceWriter, atomic_write, save_sentences
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import normalize
-from typing import List, Dict, Tuple, Type, Union
+from typing import Callable, Iterable, Iterator, List, Dict, Tuple, Type, Union
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
-                    level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# with `show_progress=None`, a progress bar is only drawn for inputs longer than this many batches
+PROGRESS_MIN_BATCHES = 10
+
 class SimCSE(object):
     """
     A class for embedding sentences, calculating similarities, and retriving sentences by SimCSE.
@@ -22,34 +40,286 @@ class SimCSE(object):
                 device: str = None,
                 num_cells: int = 100,
                 num_cells_in_search: int = 10,
-                pooler = None):
+                pooler = None,
+                cache_dir: str = None,
+                cache_size: int = 0,
+                num_workers: int = 0,
+                quantize: str = None,
+                quantize_cache_dir: str = None,
+                backend: str = None,
+                num_layers: int = None,
+                search_cache_size: int = 0,
+                search_cache_ttl: float = None,
+                collect_metrics: bool = False,
+                show_progress: bool = None,
+                progress_callback: Callable[[int, int], None] = None):
 
+        self.model_name_or_path = model_name_or_path
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-        self.model = AutoModel.from_pretrained(model_name_or_path)
         if device is None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
 
+        # `backend` ("onnx" or "torchscript") runs a model written by `python -m simcse.export`,
+        # with the pooler fused into the graph; `model_name_or_path` is then its output directory
+        self.backend = backend
+        if backend is not None:
+            if quantize is not None or num_layers is not None:
+                raise ValueError("`quantize` and `num_layers` are fixed when exporting the model.")
+            self.model = ExportedEncoder(model_name_or_path, device=device)
+            if backend != self.model.format:
+                raise ValueError("%s holds a %s model, not %s." % (model_name_or_path, self.model.format, backend))
+            if pooler is not None and pooler != self.model.pooler:
+                raise ValueError("The model was exported with the %s pooler." % self.model.pooler)
+            pooler = self.model.pooler
+            self.hidden_size = self.model.hidden_size
+        else:
+            # `quantize` ("dynamic-int8", "fp16" or "bf16") trades some accuracy for faster inference;
+            # check the loss with `evaluation.py --quantize ... --quantize_check`
+            if quantize == "dynamic-int8" and device != "cpu":
+                raise ValueError("dynamic-int8 quantization only runs on CPU.")
+            self.model = load_model(model_name_or_path, quantize=quantize, cache_dir=quantize_cache_dir)
+            self.hidden_size = self.model.config.hidden_size
+            # with `num_layers`, only the first layers run (early exit): faster, approximate embeddings
+            if num_layers is not None:
+                truncate_layers(self.model, num_layers)
+        self.quantize = quantize
+        self.quantize_cache_dir = quantize_cache_dir
+        self.num_layers = num_layers
+
         self.index = None
         self.is_faiss_index = False
         self.num_cells = num_cells
         self.num_cells_in_search = num_cells_in_search
 
         if pooler is not None:
+            if pooler not in POOLERS:
+                raise ValueError("Unknown pooler %s. Choose from %s." % (pooler, ", ".join(POOLERS)))
             self.pooler = pooler
         elif "unsup" in model_name_or_path:
             logger.info("Use `cls_before_pooler` for unsupervised models. If you want to use other pooling policy, specify `pooler` argument.")
             self.pooler = "cls_before_pooler"
         else:
             self.pooler = "cls"
+
+        # embeddings of previously seen sentences are kept in memory (`cache_size` vectors)
+        # and/or on disk (`cache_dir`), so only new sentences go through the model
+        if cache_dir is not None or cache_size > 0:
+            self.cache = EmbeddingCache(cache_dir=cache_dir, max_memory_items=cache_size)
+            # the checkpoint's files are part of the cache keys, so a checkpoint retrained in place
+            # does not get the embeddings of its previous weights
+            model_path = os.path.abspath(model_name_or_path) if os.path.isdir(model_name_or_path) else model_name_or_path
+            self.cache_model_key = "|".join([model_path, checkpoint_fingerprint(model_name_or_path)])
+        else:
+            self.cache = None
+
+        # with `num_workers` > 1, CPU encoding is sharded over a pool of processes that each
+        # load their own copy of the model; the pool starts on first use
+        self.num_workers = num_workers
+        self.pool = None
+
+        # repeated queries to `search` skip the model (cached query embeddings) and, until the
+        # index changes, the search itself (cached results); entries expire after `search_cache_ttl` seconds
+        if search_cache_size > 0:
+            self.query_cache = LRUCache(search_cache_size, ttl=search_cache_ttl)
+            self.result_cache = LRUCache(search_cache_size, ttl=search_cache_ttl)
+        else:
+            self.query_cache = None
+            self.result_cache = None
+
+        # per-stage latency histograms and batch gauges, see `render_metrics`
+        self.metrics = Metrics(sync_cuda=device.startswith("cuda")) if collect_metrics else None
+
+        # progress of long encodes: a tqdm bar (`show_progress`: always, never, or by default only
+        # past `PROGRESS_MIN_BATCHES` batches, so that short queries skip its setup) and/or
+        # `progress_callback(num_done, num_batches)` after each batch
+        self.show_progress = show_progress
+        self.progress_callback = progress_callback
+
+    def _model_kwargs(self) -> Dict:
+        """
+        Arguments to re-create this model (without index or cache) in a worker process.
+        """
+        return {"model_name_or_path": self.model_name_or_path, "device": "cpu", "pooler": self.pooler,
+                "quantize": self.quantize, "quantize_cache_dir": self.quantize_cache_dir, "backend": self.backend,
+                "num_layers": self.num_layers, "show_progress": False}
+
+    def search_cache_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        Hits, misses and size of the query embedding and search result caches.
+        """
+        if self.query_cache is None:
+            return {}
+        return {"query_embeddings": self.query_cache.stats(), "results": self.result_cache.stats()}
+
+    def _stage(self, name: str):
+        return self.metrics.stage(name) if self.metrics is not None else contextlib.nullcontext()
+
+    def render_metrics(self) -> str:
+        """
+        The collected metrics (`collect_metrics=True`) and search cache statistics, in the
+        Prometheus text exposition format.
+        """
+        if self.metrics is None:
+            raise ValueError("Metrics are not collected. Create the model with `collect_metrics=True`.")
+        for cache, stats in self.search_cache_stats().items():
+            self.metrics.set_counter("simcse_search_cache_hits_total", stats["hits"], help="Search cache hits.", cache=cache)
+            self.metrics.set_counter("simcse_search_cache_misses_total", stats["misses"], help="Search cache misses.", cache=cache)
+            self.metrics.set_gauge("simcse_search_cache_size", stats["size"], help="Entries in the search caches.", cache=cache)
+        return self.metrics.render()
+
+    def _index_changed(self):
+        # cached results may be stale once the index changes; query embeddings do not depend on it
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def _progress(self, batches: List[List[int]]) -> Iterator[List[int]]:
+        if self.show_progress or (self.show_progress is None and len(batches) > PROGRESS_MIN_BATCHES):
+            batches = tqdm(batches)
+        if self.progress_callback is None:
+            return iter(batches)
+        return self._report_progress(batches)
+
+    def _report_progress(self, batches: List[List[int]]) -> Iterator[List[int]]:
+        for i, batch in enumerate(batches):
+            yield batch
+            self.progress_callback(i + 1, len(batches))
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
     
+    def _length_bucketed_batches(self, input_ids: List[List[int]],
+                                    batch_size: int = 64,
+                                    max_tokens: int = None) -> List[List[int]]:
+        """
+        Group sentence ids into batches of similar token length, longest first.
+        If `max_tokens` is given, a batch holds as many sentences as fit in
+        `max_tokens` padded tokens instead of a fixed `batch_size`.
+        """
+        lengths = [len(ids) for ids in input_ids]
+        order = sorted(range(len(input_ids)), key=lambda i: lengths[i], reverse=True)
+
+        batches = []
+        current = []
+        for i in order:
+            # sentences come longest first, so the first one of a batch sets its padded length
+            if len(current) > 0:
+                if max_tokens is not None:
+                    full = (len(current) + 1) * lengths[current[0]] > max_tokens
+                else:
+                    full = len(current) >= batch_size
+                if full:
+                    batches.append(current)
+                    current = []
+            current.append(i)
+        if len(current) > 0:
+            batches.append(current)
+        return batches
+
+    def _encode_batches(self, sentence: List[str],
+                        target_device: str,
+                        normalize_to_unit: bool = True,
+                        batch_size: int = 64,
+                        max_length: int = 128,
+                        sort_by_length: bool = False,
+                        max_tokens: int = None) -> Tensor:
+
+        if self.num_workers > 1 and target_device == "cpu" and len(sentence) > batch_size:
+            if self.pool is None:
+                self.pool = EncodingPool(self._model_kwargs(), self.num_workers)
+            return self.pool.encode(sentence, self.hidden_size, batch_size=batch_size,
+                                    normalize_to_unit=normalize_to_unit, max_length=max_length,
+                                    sort_by_length=sort_by_length, max_tokens=max_tokens)
+
+        # sort sentences by length to cut padding; results are put back in the input order below
+        bucketed = sort_by_length or max_tokens is not None
+        if bucketed:
+            with self._stage("tokenize"):
+                features = self.tokenizer(sentence, truncation=True, max_length=max_length)
+            batches = self._length_bucketed_batches(features["input_ids"], batch_size=batch_size, max_tokens=max_tokens)
+        else:
+            batches = [list(range(start, min(start + batch_size, len(sentence)))) for start in range(0, len(sentence), batch_size)]
+
+        embedding_list = [] 
+        with torch.no_grad():
+            for batch in self._progress(batches):
+                with self._stage("tokenize"):
+                    if bucketed:
+                        inputs = self.tokenizer.pad(
+                            {k: [features[k][i] for i in batch] for k in features},
+                            padding=True,
+                            return_tensors="pt"
+                        )
+                    else:
+                        inputs = self.tokenizer(
+                            sentence[batch[0]:batch[-1] + 1], 
+                            padding=True, 
+                            truncation=True, 
+                            max_length=max_length, 
+                            return_tensors="pt"
+                        )
+                if self.metrics is not None:
+                    mask = inputs["attention_mask"]
+                    self.metrics.set_gauge("simcse_batch_size", len(batch), help="Number of sentences in the last encoded batch.")
+                    self.metrics.set_gauge("simcse_padding_ratio", 1.0 - mask.sum().item() / mask.numel(),
+                                           help="Fraction of padding tokens in the last encoded batch.")
+                with self._stage("h2d"):
+                    inputs = {k: v.to(target_device) for k, v in inputs.items()}
+                if self.backend is not None:
+                    # the exported graph fuses the forward pass and pooling
+                    with self._stage("forward"):
+                        embeddings = self.model(inputs)
+                else:
+                    embeddings = encode_and_pool(self.model, inputs, self.pooler, stage=self._stage)
+                with self._stage("normalize"):
+                    embeddings = embeddings.float()
+                    if normalize_to_unit:
+                        embeddings = embeddings / embeddings.norm(dim=1, keepdim=True)
+                    embedding_list.append(embeddings.cpu())
+        embeddings = torch.cat(embedding_list, 0)
+
+        if bucketed:
+            order = torch.tensor([i for batch in batches for i in batch], dtype=torch.long)
+            restored = torch.empty_like(embeddings)
+            restored[order] = embeddings
+            embeddings = restored
+        return embeddings
+
+    def _encode_with_cache(self, sentence: List[str],
+                            target_device: str,
+                            normalize_to_unit: bool = True,
+                            max_length: int = 128,
+                            **kwargs) -> Tensor:
+        namespace = "|".join([self.cache_model_key, self.pooler, str(max_length), str(normalize_to_unit), str(self.quantize),
+                              str(self.backend), str(self.num_layers)])
+        keys = [EmbeddingCache.make_key(namespace, s) for s in sentence]
+        vectors = self.cache.get_many(keys)
+
+        # only cache misses (deduplicated) are sent through the model
+        missing = collections.OrderedDict()
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(keys[i], []).append(i)
+        if len(missing) > 0:
+            new_vectors = self._encode_batches([sentence[ids[0]] for ids in missing.values()], target_device,
+                                               normalize_to_unit=normalize_to_unit, max_length=max_length, **kwargs).numpy()
+            self.cache.put_many(list(missing), new_vectors)
+            for vector, ids in zip(new_vectors, missing.values()):
+                for i in ids:
+                    vectors[i] = vector
+        return torch.from_numpy(np.stack(vectors))
+
     def encode(self, sentence: Union[str, List[str]], 
                 device: str = None, 
                 return_numpy: bool = False,
                 normalize_to_unit: bool = True,
                 keepdim: bool = False,
                 batch_size: int = 64,
-                max_length: int = 128) -> Union[ndarray, Tensor]:
+                max_length: int = 128,
+                sort_by_length: bool = False,
+                max_tokens: int = None) -> Union[ndarray, Tensor]:
 
         target_device = self.device if device is None else device
         self.model = self.model.to(target_device)
@@ -59,29 +329,9 @@ class SimCSE(object):
             sentence = [sentence]
             single_sentence = True
 
-        embedding_list = [] 
-        with torch.no_grad():
-            total_batch = len(sentence) // batch_size + (1 if len(sentence) % batch_size > 0 else 0)
-            for batch_id in tqdm(range(total_batch)):
-                inputs = self.tokenizer(
-                    sentence[batch_id*batch_size:(batch_id+1)*batch_size], 
-                    padding=True, 
-                    truncation=True, 
-                    max_length=max_length, 
-                    return_tensors="pt"
-                )
-                inputs = {k: v.to(target_device) for k, v in inputs.items()}
-                outputs = self.model(**inputs, return_dict=True)
-                if self.pooler == "cls":
-                    embeddings = outputs.pooler_output
-                elif self.pooler == "cls_before_pooler":
-                    embeddings = outputs.last_hidden_state[:, 0]
-                else:
-                    raise NotImplementedError
-                if normalize_to_unit:
-                    embeddings = embeddings / embeddings.norm(dim=1, keepdim=True)
-                embedding_list.append(embeddings.cpu())
-        embeddings = torch.cat(embedding_list, 0)
+        encode_fn = self._encode_with_cache if self.cache is not None else self._encode_batches
+        embeddings = encode_fn(sentence, target_device, normalize_to_unit=normalize_to_unit, batch_size=batch_size,
+                               max_length=max_length, sort_by_length=sort_by_length, max_tokens=max_tokens)
         
         if single_sentence and not keepdim:
             embeddings = embeddings[0]
@@ -90,6 +340,84 @@ class SimCSE(object):
             return embeddings.numpy()
         return embeddings
     
+    def _iter_sentences(self, sentences_or_file_path: Union[str, Iterable[str]]) -> Iterator[str]:
+        # if the input is a string, we assume it's the path of file that stores various sentences (optionally gzipped);
+        # lines of a file (path or open file) are stripped of trailing whitespace, other iterables are taken as they are
+        if isinstance(sentences_or_file_path, str):
+            open_fn = gzip.open if sentences_or_file_path.endswith(".gz") else open
+            with open_fn(sentences_or_file_path, "rt") as f:
+                for line in f:
+                    yield line.rstrip()
+        elif isinstance(sentences_or_file_path, io.IOBase):
+            for line in sentences_or_file_path:
+                yield line.rstrip()
+        else:
+            for sentence in sentences_or_file_path:
+                yield sentence
+
+    def encode_iter(self, sentences_or_file_path: Union[str, Iterable[str]],
+                    chunk_size: int = 10000,
+                    device: str = None,
+                    return_numpy: bool = True,
+                    normalize_to_unit: bool = True,
+                    batch_size: int = 64,
+                    max_length: int = 128,
+                    sort_by_length: bool = False,
+                    max_tokens: int = None) -> Iterator[Union[ndarray, Tensor]]:
+        """
+        Lazily encode sentences from a list, a generator, an open file or a file path
+        and yield their embeddings in chunks of `chunk_size` rows, in input order.
+        Only one chunk of sentences and embeddings is held in memory at a time.
+        """
+        chunk = []
+        for sentence in self._iter_sentences(sentences_or_file_path):
+            chunk.append(sentence)
+            if len(chunk) == chunk_size:
+                yield self.encode(chunk, device=device, return_numpy=return_numpy, normalize_to_unit=normalize_to_unit,
+                                  keepdim=True, batch_size=batch_size, max_length=max_length,
+                                  sort_by_length=sort_by_length, max_tokens=max_tokens)
+                chunk = []
+        if len(chunk) > 0:
+            yield self.encode(chunk, device=device, return_numpy=return_numpy, normalize_to_unit=normalize_to_unit,
+                              keepdim=True, batch_size=batch_size, max_length=max_length,
+                              sort_by_length=sort_by_length, max_tokens=max_tokens)
+
+    def encode_to_memmap(self, sentences_or_file_path: Union[str, Iterable[str]],
+                            output_path: str,
+                            num_sentences: int = None,
+                            dtype: str = "float32",
+                            chunk_size: int = 10000,
+                            device: str = None,
+                            normalize_to_unit: bool = True,
+                            batch_size: int = 64,
+                            max_length: int = 128) -> np.memmap:
+        """
+        Encode sentences chunk by chunk straight into a preallocated `.npy` file at `output_path`
+        and return it as a memory map. `num_sentences` is required unless the input is a file
+        path (lines are counted) or has a length.
+        """
+        if num_sentences is None:
+            if isinstance(sentences_or_file_path, str):
+                num_sentences = sum(1 for _ in self._iter_sentences(sentences_or_file_path))
+            elif hasattr(sentences_or_file_path, "__len__"):
+                num_sentences = len(sentences_or_file_path)
+            else:
+                raise ValueError("`num_sentences` must be given when encoding from a generator or an open file.")
+
+        embeddings = np.lib.format.open_memmap(output_path, mode="w+", dtype=dtype,
+                                               shape=(num_sentences, self.hidden_size))
+        offset = 0
+        for chunk in self.encode_iter(sentences_or_file_path, chunk_size=chunk_size, device=device,
+                                      normalize_to_unit=normalize_to_unit, batch_size=batch_size, max_length=max_length):
+            if offset + len(chunk) > num_sentences:
+                raise ValueError("Got more sentences than `num_sentences` (%d)." % num_sentences)
+            embeddings[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        if offset != num_sentences:
+            raise ValueError("Got %d sentences but `num_sentences` is %d." % (offset, num_sentences))
+        embeddings.flush()
+        return embeddings
+
     def similarity(self, queries: Union[str, List[str]], 
                     keys: Union[str, List[str], ndarray], 
                     device: str = None) -> Union[float, ndarray]:
@@ -109,7 +437,8 @@ class SimCSE(object):
             key_vecs = key_vecs.reshape(1, -1)
         
         # returns an N*M similarity array
-        similarities = cosine_similarity(query_vecs, key_vecs)
+        with self._stage("similarity"):
+            similarities = cosine_similarity(query_vecs, key_vecs)
         
         if single_query:
             similarities = similarities[0]
@@ -122,7 +451,25 @@ class SimCSE(object):
                         use_faiss: bool = None,
                         faiss_fast: bool = False,
                         device: str = None,
-                        batch_size: int = 64):
+                        batch_size: int = 64,
+                        chunk_size: int = 10000,
+                        index_type: str = None,
+                        index_params: Dict = None,
+                        ids: List = None):
+        """
+        Encode sentences and build a search index over them. `ids` gives each sentence a stable
+        id for `remove_from_index`/`upsert`; by default a sentence's id is its position. With faiss, `index_type` is one of
+        "flat" (exact), "ivf", "ivf_pq", "hnsw" or "sq8" (`faiss_fast=True` is a shortcut for "ivf"),
+        and `index_params` overrides that type's parameters, see `simcse.index.FAISS_INDEX_PARAMS`.
+        Without faiss, "flat" is a brute-force NumPy matrix and the other types fall back to the
+        NumPy IVF index (`simcse.index.IVFIndex`). Indexes that need training are trained on the
+        first `chunk_size` sentences. A file path, generator or open file is streamed: its sentences
+        are encoded chunk by chunk and spooled to a temporary offset-indexed file (see
+        `SentenceStore`) instead of being read into a list. Lines of a file (path or open file) are
+        stripped of trailing whitespace; the sentences of other iterables are used as they are.
+        """
+        if index_type is None:
+            index_type = "ivf" if faiss_fast else "flat"
 
         if use_faiss is None or use_faiss:
             try:
@@ -130,32 +477,73 @@ class SimCSE(object):
                 assert hasattr(faiss, "IndexFlatIP")
                 use_faiss = True 
             except:
-                logger.warning("Fail to import faiss. If you want to use faiss, install faiss through PyPI. Now the program continues with brute force search.")
+                logger.warning("Fail to import faiss. If you want to use faiss, install faiss through PyPI. Now the program continues with NumPy search.")
                 use_faiss = False
         
         # if the input sentence is a string, we assume it's the path of file that stores various sentences
-        if isinstance(sentences_or_file_path, str):
-            sentences = []
-            with open(sentences_or_file_path, "r") as f:
-                logging.info("Loading sentences from %s ..." % (sentences_or_file_path))
-                for line in tqdm(f):
-                    sentences.append(line.rstrip())
-            sentences_or_file_path = sentences
-        
-        logger.info("Encoding embeddings for sentences...")
-        embeddings = self.encode(sentences_or_file_path, device=device, batch_size=batch_size, normalize_to_unit=True, return_numpy=True)
+        writer, spool_dir = None, None
+        if isinstance(sentences_or_file_path, str) or not hasattr(sentences_or_file_path, "__len__"):
+            if isinstance(sentences_or_file_path, str):
+                logger.info("Loading sentences from %s ..." % (sentences_or_file_path))
+            spool_dir = tempfile.mkdtemp(prefix="simcse-sentences-")
+            writer = SentenceWriter(os.path.join(spool_dir, "sentences.bin"), os.path.join(spool_dir, "sentences.offsets.npy"))
+            sentences = writer.tee(tqdm(self._iter_sentences(sentences_or_file_path), disable=self.show_progress is False))
+        else:
+            # copy, since later additions extend this list
+            sentences = list(sentences_or_file_path)
+        try:
+            # the previous index is kept until the new one is complete
+            index, is_faiss_index = self._build_index(sentences, use_faiss, index_type, index_params, ids, device, batch_size, chunk_size)
+            if writer is not None:
+                writer.close()
+                index["sentences"] = SentenceStore(writer.data_path, writer.offsets_path, mmap=True)
+            else:
+                index["sentences"] = sentences
+            self.index, self.is_faiss_index = index, is_faiss_index
+        finally:
+            if writer is not None:
+                writer.close()
+                # the memory maps outlive the files on POSIX; elsewhere the files stay until exit
+                shutil.rmtree(spool_dir, ignore_errors=True)
+        self._index_changed()
+        logger.info("Finished")
 
-        logger.info("Building index...")
-        self.index = {"sentences": sentences_or_file_path}
+    def _build_index(self, sentences: Iterable[str], use_faiss: bool, index_type: str, index_params: Dict,
+                        ids: List, device: str, batch_size: int, chunk_size: int) -> Tuple[Dict, bool]:
+        # embeddings are produced chunk by chunk and never concatenated, so peak memory
+        # is the index itself plus one chunk
+        logger.info("Encoding embeddings for sentences and building index...")
+        built = {"id_map": IdMap()}
+        dim = self.hidden_size
+        chunks = self.encode_iter(sentences, chunk_size=chunk_size, device=device, batch_size=batch_size, normalize_to_unit=True, return_numpy=True)
+        # the first chunk bounds the number of training vectors
+        first_chunk = next(chunks, None)
+        num_training = 0 if first_chunk is None else len(first_chunk)
+        chunks = self._add_chunk_ids(itertools.chain([] if first_chunk is None else [first_chunk], chunks), built["id_map"], ids)
         
+        if use_faiss or index_type != "flat":
+            index_params = dict(index_params or {})
+            if not use_faiss and index_type != "ivf":
+                logger.warning("Index type %s needs faiss. Use the NumPy IVF index instead." % index_type)
+                index_type, index_params = "ivf", {k: v for k, v in index_params.items() if k in FAISS_INDEX_PARAMS["ivf"]}
+            if "nlist" in FAISS_INDEX_PARAMS.get(index_type, {}):
+                index_params.setdefault("nlist", self.num_cells)
+                index_params.setdefault("nprobe", self.num_cells_in_search)
+                # there cannot be more cells than training vectors
+                index_params["nlist"] = min(index_params["nlist"], num_training)
+            params = resolve_faiss_params(index_type, dim, index_params)
+            built["index_type"], built["index_params"] = index_type, params
+        else:
+            built["index_type"], built["index_params"] = "flat", {}
+
         if use_faiss:
-            quantizer = faiss.IndexFlatIP(embeddings.shape[1])  
-            if faiss_fast:
-                index = faiss.IndexIVFFlat(quantizer, embeddings.shape[1], min(self.num_cells, len(sentences_or_file_path))) 
-            else:
-                index = quantizer
+            import faiss
+            index = build_faiss_index(index_type, dim, params)
+            if "nlist" not in params:
+                # IVF indexes store ids natively, the others need a wrapper to support removal
+                index = faiss.IndexIDMap2(index)
 
-            if (self.device == "cuda" and device != "cpu") or device == "cuda":
+            if ((self.device == "cuda" and device != "cpu") or device == "cuda") and index_type != "hnsw":
                 if hasattr(faiss, "StandardGpuResources"):
                     logger.info("Use GPU-version faiss")
                     res = faiss.StandardGpuResources()
@@ -166,82 +554,403 @@ class SimCSE(object):
             else: 
                 logger.info("Use CPU-version faiss")
 
-            if faiss_fast:            
-                index.train(embeddings.astype(np.float32))
-            index.add(embeddings.astype(np.float32))
-            index.nprobe = min(self.num_cells_in_search, len(sentences_or_file_path))
-            self.is_faiss_index = True
+            for embeddings, rows in chunks:
+                if not index.is_trained:
+                    if index_type == "ivf_pq" and len(embeddings) < 2 ** params["nbits"]:
+                        raise ValueError("Training an ivf_pq index with nbits=%d needs at least %d sentences in the first chunk." % (params["nbits"], 2 ** params["nbits"]))
+                    index.train(embeddings.astype(np.float32))
+                index.add_with_ids(embeddings.astype(np.float32), rows)
+
+            # defaults for query-time parameters, which `search` can override per call
+            search_params = {"nprobe": params.get("nprobe"), "ef_search": params.get("ef_search")}
+            if search_params["nprobe"] is not None:
+                search_params["nprobe"] = min(search_params["nprobe"], params["nlist"])
+            set_faiss_search_params(index, **search_params)
+            built["search_params"] = search_params
+        elif index_type == "ivf":
+            # approximate search without faiss
+            index = IVFIndex(dim, nlist=params["nlist"], nprobe=min(params["nprobe"], params["nlist"]))
+            for chunk_id, (embeddings, rows) in enumerate(chunks):
+                if chunk_id == 0:
+                    index.train(embeddings)
+                index.add(embeddings, rows)
         else:
-            index = embeddings
-            self.is_faiss_index = False
-        self.index["index"] = index
-        logger.info("Finished")
+            index = EmbeddingStore(dim, capacity=len(sentences) if isinstance(sentences, list) else 0)
+            for embeddings, rows in chunks:
+                index.add(embeddings)
+        built["index"] = index
+        built["trained_size"] = built["id_map"].size
+        return built, use_faiss
+
+    def _add_chunk_ids(self, chunks: Iterator[ndarray], id_map: IdMap, ids: List = None) -> Iterator[Tuple[ndarray, ndarray]]:
+        # register each chunk's sentences in the id map as it is encoded, since a stream's length is unknown
+        for embeddings in chunks:
+            chunk_ids = None if ids is None else ids[id_map.size:id_map.size + len(embeddings)]
+            if chunk_ids is not None and len(chunk_ids) < len(embeddings):
+                raise ValueError("Got %d ids for at least %d sentences." % (len(ids), id_map.size + len(embeddings)))
+            yield embeddings, id_map.add(len(embeddings), chunk_ids)
+        if ids is not None and len(ids) != id_map.size:
+            raise ValueError("Got %d ids for %d sentences." % (len(ids), id_map.size))
 
     def add_to_index(self, sentences_or_file_path: Union[str, List[str]],
                         device: str = None,
-                        batch_size: int = 64):
-        
+                        batch_size: int = 64,
+                        retrain_ratio: float = None,
+                        ids: List = None):
+        """
+        Encode sentences and append them to the index under `ids` (by default, their positions).
+        With `retrain_ratio`, an IVF index is re-trained once it holds `retrain_ratio` times as
+        many vectors as it was last trained with, so its cells keep up with the data distribution.
+        """
+
         # if the input sentence is a string, we assume it's the path of file that stores various sentences
         if isinstance(sentences_or_file_path, str):
-            sentences = []
-            with open(sentences_or_file_path, "r") as f:
-                logging.info("Loading sentences from %s ..." % (sentences_or_file_path))
-                for line in tqdm(f):
-                    sentences.append(line.rstrip())
-            sentences_or_file_path = sentences
+            logger.info("Loading sentences from %s ..." % (sentences_or_file_path))
+            sentences_or_file_path = list(tqdm(self._iter_sentences(sentences_or_file_path), disable=self.show_progress is False))
         
         logger.info("Encoding embeddings for sentences...")
-        embeddings = self.encode(sentences_or_file_path, device=device, batch_size=batch_size, normalize_to_unit=True, return_numpy=True)
-        
+        embeddings = self.encode(sentences_or_file_path, device=device, batch_size=batch_size, normalize_to_unit=True, keepdim=True, return_numpy=True)
+        self._add_embeddings(sentences_or_file_path, embeddings, ids)
+
+        trained_size = self.index.get("trained_size", 0)
+        if retrain_ratio is not None and "nlist" in self.index["index_params"] and len(self.index["id_map"]) >= retrain_ratio * trained_size:
+            self.retrain_index()
+        logger.info("Finished")
+
+    def _writable_faiss_index(self):
+        # an IVF index loaded with `mmap=True` is read-only until copied into memory
+        index = self.index["index"]
+        if make_faiss_index_writable(index):
+            logger.info("Copied the memory-mapped inverted lists into memory to modify the index")
+        return index
+
+    def _add_embeddings(self, sentences: List[str], embeddings: ndarray, ids: List = None):
+        rows = self.index["id_map"].add(len(sentences), ids)
+        index = self._writable_faiss_index() if self.is_faiss_index else self.index["index"]
+        if isinstance(index, EmbeddingStore):
+            index.add(embeddings)
+        elif isinstance(index, IVFIndex):
+            index.add(embeddings, rows)
+        else:
+            index.add_with_ids(embeddings.astype(np.float32), rows)
+        self.index["sentences"] += sentences
+        self._index_changed()
+
+    def remove_from_index(self, ids: List, compact_ratio: float = 0.2):
+        """
+        Remove the sentences with the given ids from the index. Faiss and NumPy IVF indexes
+        drop the vectors right away; the brute-force index tombstones them and compacts itself
+        once more than `compact_ratio` of its rows are tombstones. HNSW graphs cannot drop
+        vectors, so theirs stay in the graph and are skipped at search time.
+        """
+        id_map = self.index["id_map"]
+        rows = id_map.rows_of(ids)
+        index = self._writable_faiss_index() if self.is_faiss_index else self.index["index"]
+        if isinstance(index, EmbeddingStore):
+            index.delete(rows)
+        elif isinstance(index, IVFIndex):
+            index.remove_ids(rows)
+        elif self.index["index_type"] == "hnsw":
+            # the id map's removed rows are excluded from the searches
+            self.index.pop("excluded_rows", None)
+        else:
+            index.remove_ids(rows)
+        id_map.remove(ids)
+        self._index_changed()
+
+        # removed sentences are never returned, so free their text
+        for row in rows.tolist():
+            self.index["sentences"][row] = ""
+
+        if isinstance(index, EmbeddingStore) and index.num_deleted > compact_ratio * len(index):
+            self.compact_index()
+
+    def compact_index(self):
+        """
+        Drop the tombstoned rows of the brute-force index. Ids are kept, positions change.
+        """
+        index = self.index["index"]
+        if not isinstance(index, EmbeddingStore):
+            return
+        kept = index.compact()
+        sentences = self.index["sentences"]
+        self.index["sentences"] = [sentences[row] for row in kept.tolist()]
+        self.index["id_map"].compact(kept)
+        self._index_changed()
+        logger.info("Compacted the index to %d sentences" % len(kept))
+
+    def upsert(self, ids: List, sentences: List[str],
+                device: str = None,
+                batch_size: int = 64):
+        """
+        Insert sentences under `ids`, replacing the sentences that already have one of these ids.
+        The brute-force index overwrites existing rows in place; the others remove them and add
+        the new ones (for HNSW, see `remove_from_index`).
+        """
+        if len(ids) != len(sentences):
+            raise ValueError("Got %d ids but %d sentences." % (len(ids), len(sentences)))
+        embeddings = self.encode(sentences, device=device, batch_size=batch_size, normalize_to_unit=True, keepdim=True, return_numpy=True)
+        id_map = self.index["id_map"]
+        existing = np.array([i in id_map for i in ids], dtype=bool)
+
+        if isinstance(self.index["index"], EmbeddingStore):
+            rows = id_map.rows_of([i for i, e in zip(ids, existing) if e])
+            self.index["index"].update(rows, embeddings[existing])
+            for row, sentence in zip(rows.tolist(), [s for s, e in zip(sentences, existing) if e]):
+                self.index["sentences"][row] = sentence
+            self._index_changed()
+            new = ~existing
+        else:
+            if existing.any():
+                self.remove_from_index([i for i, e in zip(ids, existing) if e])
+            new = np.ones(len(ids), dtype=bool)
+        if new.any():
+            self._add_embeddings([s for s, n in zip(sentences, new) if n], embeddings[new], [i for i, n in zip(ids, new) if n])
+
+    def update_index(self, ids: List, sentences: List[str],
+                        device: str = None,
+                        batch_size: int = 64):
+        """
+        Replace the sentences with the given (existing) ids.
+        """
+        for i in ids:
+            if i not in self.index["id_map"]:
+                raise KeyError("Id %s is not in the index." % (i,))
+        self.upsert(ids, sentences, device=device, batch_size=batch_size)
+
+    def retrain_index(self, sample_size: int = 10000):
+        """
+        Re-train the coarse quantizer of an IVF index on a sample of the vectors it holds and
+        re-assign every vector to the new cells. Product-quantized vectors are re-encoded from
+        their (lossy) reconstructions.
+        """
+        index = self.index["index"]
+        if isinstance(index, IVFIndex):
+            index.retrain(sample_size)
+        elif self.is_faiss_index and "nlist" in self.index["index_params"]:
+            import faiss
+            if is_faiss_gpu_index(index):
+                raise NotImplementedError("Re-training a GPU faiss index is not supported.")
+            index = self._writable_faiss_index()
+            # vectors are stored under their row ids, which need a hash table to be looked up
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            rows = self.index["id_map"].live_rows()
+            rng = np.random.RandomState(1234)
+            sample = np.sort(rng.choice(rows, min(sample_size, len(rows)), replace=False))
+            new_index = build_faiss_index(self.index["index_type"], index.d, self.index["index_params"])
+            new_index.train(index.reconstruct_batch(sample))
+            for start in range(0, len(rows), sample_size):
+                new_index.add_with_ids(index.reconstruct_batch(rows[start:start + sample_size]), rows[start:start + sample_size])
+            set_faiss_search_params(new_index, **self.index.get("search_params", {}))
+            self.index["index"] = new_index
+        else:
+            raise ValueError("Only IVF indexes can be re-trained.")
+        self.index["trained_size"] = len(self.index["id_map"])
+        self._index_changed()
+        logger.info("Re-trained the index on %d vectors" % min(sample_size, len(self.index["id_map"])))
+
+    def save_index(self, path: str, dtype: str = "float32"):
+        """
+        Save the current index to the directory `path`: the sentences in an offset-indexed
+        file, and either the embedding matrix as a raw `.npy` (`dtype` is float32 or float16),
+        the NumPy IVF index's arrays, or the faiss index in its native format. Files are written
+        under temporary names and then renamed, so `path` may be the directory the index was
+        memory-mapped from, and `meta.json` is written last.
+        """
+        if self.index is None:
+            raise ValueError("There is no index to save. Call `build_index` first.")
+        os.makedirs(path, exist_ok=True)
+
+        # ids that JSON cannot encode fail here, before any file is replaced
+        id_map = self.index["id_map"]
+        ids_json = None if id_map.ids is None else json.dumps(id_map.ids)
+        # meta.json marks a complete save: it is removed first and written last, so that a save
+        # that fails halfway leaves no loadable mix of old and new files
+        if os.path.exists(os.path.join(path, "meta.json")):
+            os.remove(os.path.join(path, "meta.json"))
+        save_sentences(self.index["sentences"], os.path.join(path, "sentences.bin"), os.path.join(path, "sentences.offsets.npy"))
+        meta = {
+            "model_name_or_path": self.model_name_or_path,
+            "pooler": self.pooler,
+            "is_faiss_index": self.is_faiss_index,
+            "num_sentences": len(self.index["sentences"]),
+            "index_type": self.index["index_type"],
+            "index_params": self.index["index_params"],
+            "trained_size": self.index.get("trained_size", 0),
+        }
+        if id_map.ids is None:
+            meta["removed_rows"] = sorted(id_map.removed)
+        else:
+            with atomic_write(os.path.join(path, "ids.json")) as tmp_path:
+                with open(tmp_path, "w") as f:
+                    f.write(ids_json)
         if self.is_faiss_index:
-            self.index["index"].add(embeddings.astype(np.float32))
+            import faiss
+            index = self.index["index"]
+            if is_faiss_gpu_index(index):
+                index = faiss.index_gpu_to_cpu(index)
+            with atomic_write(os.path.join(path, "index.faiss")) as tmp_path:
+                faiss.write_index(index, tmp_path)
+            meta["search_params"] = self.index.get("search_params", {})
+        elif isinstance(self.index["index"], IVFIndex):
+            self.index["index"].save(path)
+            meta["ivf_nprobe"] = self.index["index"].nprobe
         else:
-            self.index["index"] = np.concatenate((self.index["index"], embeddings))
-        self.index["sentences"] += sentences_or_file_path
-        logger.info("Finished")
+            store = self.index["index"]
+            with atomic_write(os.path.join(path, "embeddings.npy")) as tmp_path:
+                np.save(tmp_path, np.ascontiguousarray(store.vectors, dtype=dtype))
+            deleted_path = os.path.join(path, "deleted.npy")
+            if store.num_deleted > 0:
+                with atomic_write(deleted_path) as tmp_path:
+                    np.save(tmp_path, ~store.valid)
+            elif os.path.exists(deleted_path):
+                # left over from an earlier save into the same directory
+                os.remove(deleted_path)
+
+        with atomic_write(os.path.join(path, "meta.json")) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f, indent=2)
+        logger.info("Saved index with %d sentences to %s" % (meta["num_sentences"], path))
+
+    def load_index(self, path: str, mmap: bool = True):
+        """
+        Load an index written by `save_index`. With `mmap=True` the embeddings and sentences
+        are memory-mapped instead of read into memory, so startup does not depend on the
+        corpus size and several processes can share one copy through the page cache.
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["model_name_or_path"] != self.model_name_or_path or meta["pooler"] != self.pooler:
+            logger.warning("The index at %s was built with %s (pooler: %s), but the current model is %s (pooler: %s)." % (
+                path, meta["model_name_or_path"], meta["pooler"], self.model_name_or_path, self.pooler))
+
+        self.index = {
+            "sentences": SentenceStore(os.path.join(path, "sentences.bin"), os.path.join(path, "sentences.offsets.npy"), mmap=mmap),
+            "index_type": meta["index_type"],
+            "index_params": meta["index_params"],
+            "trained_size": meta["trained_size"],
+        }
+        if "removed_rows" in meta:
+            self.index["id_map"] = IdMap(size=meta["num_sentences"], removed=meta["removed_rows"])
+        else:
+            with open(os.path.join(path, "ids.json")) as f:
+                self.index["id_map"] = IdMap(ids=json.load(f))
+        if meta["is_faiss_index"]:
+            import faiss
+            index_path = os.path.join(path, "index.faiss")
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP) if mmap else faiss.read_index(index_path)
+            search_params = meta.get("search_params", {})
+            set_faiss_search_params(index, **search_params)
+            self.index["search_params"] = search_params
+            self.is_faiss_index = True
+        elif "ivf_nprobe" in meta:
+            index = IVFIndex.load(path, nprobe=meta["ivf_nprobe"], mmap=mmap)
+            self.is_faiss_index = False
+        else:
+            deleted_path = os.path.join(path, "deleted.npy")
+            index = EmbeddingStore.wrap(np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r" if mmap else None),
+                                        deleted=np.load(deleted_path) if os.path.exists(deleted_path) else None)
+            self.is_faiss_index = False
+        self.index["index"] = index
+        self._index_changed()
+        logger.info("Loaded index with %d sentences from %s" % (meta["num_sentences"], path))
 
 
     
     def search(self, queries: Union[str, List[str]], 
                 device: str = None, 
                 threshold: float = 0.6,
-                top_k: int = 5) -> Union[List[Tuple[str, float]], List[List[Tuple[str, float]]]]:
-        
-        if not self.is_faiss_index:
-            if isinstance(queries, list):
-                combined_results = []
-                for query in queries:
-                    results = self.search(query, device)
-                    combined_results.append(results)
-                return combined_results
-            
-            similarities = self.similarity(queries, self.index["index"]).tolist()
-            id_and_score = []
-            for i, s in enumerate(similarities):
-                if s >= threshold:
-                    id_and_score.append((i, s))
-            id_and_score = sorted(id_and_score, key=lambda x: x[1], reverse=True)[:top_k]
-            results = [(self.index["sentences"][idx], score) for idx, score in id_and_score]
-            return results
+                top_k: int = 5,
+                max_block_bytes: int = 256 * 1024 * 1024,
+                nprobe: int = None,
+                ef_search: int = None,
+                return_ids: bool = False) -> Union[List[Tuple[str, float]], List[List[Tuple[str, float]]]]:
+        """
+        Retrieve the `top_k` most similar indexed sentences with a similarity of at least `threshold`,
+        as (sentence, score) pairs or, with `return_ids`, (id, sentence, score) triples.
+        `nprobe` (IVF indexes) and `ef_search` (HNSW) trade speed for recall for this call only.
+        """
+        single_query = isinstance(queries, str)
+        query_list = [queries] if single_query else queries
+        search_kwargs = {"device": device, "threshold": threshold, "top_k": top_k, "max_block_bytes": max_block_bytes,
+                         "nprobe": nprobe, "ef_search": ef_search, "return_ids": return_ids}
+
+        if self.result_cache is None:
+            results = self._search(query_list, **search_kwargs)
         else:
-            query_vecs = self.encode(queries, device=device, normalize_to_unit=True, keepdim=True, return_numpy=True)
-
-            distance, idx = self.index["index"].search(query_vecs.astype(np.float32), top_k)
-            
-            def pack_single_result(dist, idx):
-                results = [(self.index["sentences"][i], s) for i, s in zip(idx, dist) if s >= threshold]
-                return results
-            
-            if isinstance(queries, list):
-                combined_results = []
-                for i in range(len(queries)):
-                    results = pack_single_result(distance[i], idx[i])
-                    combined_results.append(results)
-                return combined_results
+            keys = [(query, threshold, top_k, nprobe, ef_search, return_ids) for query in query_list]
+            results = [self.result_cache.get(key) for key in keys]
+            missing = [i for i, result in enumerate(results) if result is None]
+            if len(missing) > 0:
+                new_results = self._search([query_list[i] for i in missing], **search_kwargs)
+                for i, result in zip(missing, new_results):
+                    self.result_cache.put(keys[i], result)
+                    results[i] = result
+            # callers get their own lists, the cached ones stay untouched
+            results = [list(result) for result in results]
+        return results[0] if single_query else results
+
+    def _encode_queries(self, queries: List[str], device: str = None) -> ndarray:
+        if self.query_cache is None:
+            return self.encode(queries, device=device, normalize_to_unit=True, keepdim=True, return_numpy=True)
+        query_vecs = [self.query_cache.get(query) for query in queries]
+        missing = [i for i, vec in enumerate(query_vecs) if vec is None]
+        if len(missing) > 0:
+            new_vecs = self.encode([queries[i] for i in missing], device=device, normalize_to_unit=True, keepdim=True, return_numpy=True)
+            for i, vec in zip(missing, new_vecs):
+                self.query_cache.put(queries[i], vec)
+                query_vecs[i] = vec
+        return np.stack(query_vecs)
+
+    def _search(self, queries: List[str],
+                device: str = None,
+                threshold: float = 0.6,
+                top_k: int = 5,
+                max_block_bytes: int = 256 * 1024 * 1024,
+                nprobe: int = None,
+                ef_search: int = None,
+                return_ids: bool = False) -> List[List[Tuple[str, float]]]:
+        # all queries are encoded in one call and searched together
+        query_vecs = self._encode_queries(queries, device=device)
+
+        with self._stage("search"):
+            if self.is_faiss_index:
+                params = None
+                excluded = None
+                if self.index["index_type"] == "hnsw":
+                    if "excluded_rows" not in self.index:
+                        self.index["excluded_rows"] = self.index["id_map"].dead_rows()
+                    excluded = self.index["excluded_rows"]
+                if nprobe is not None or ef_search is not None or (excluded is not None and len(excluded) > 0):
+                    params = faiss_search_params(self.index["index"], nprobe=nprobe, ef_search=ef_search, excluded=excluded)
+                if params is not None:
+                    distance, idx = self.index["index"].search(query_vecs.astype(np.float32), top_k, params=params)
+                else:
+                    distance, idx = self.index["index"].search(query_vecs.astype(np.float32), top_k)
+            elif isinstance(self.index["index"], IVFIndex):
+                distance, idx = self.index["index"].search(query_vecs, top_k, nprobe=nprobe)
             else:
-                return pack_single_result(distance[0], idx[0])
+                # embeddings are unit-normalized, so inner product is cosine similarity
+                store = self.index["index"]
+                distance, idx = exact_search(query_vecs, store.vectors, top_k, max_block_bytes=max_block_bytes, valid=store.valid)
+        
+        def pack_single_result(dist, idx):
+            if return_ids:
+                id_map = self.index["id_map"]
+                return [(id_map.id_of(i), self.index["sentences"][i], s) for i, s in zip(idx.tolist(), dist.tolist()) if i >= 0 and s >= threshold]
+            results = [(self.index["sentences"][i], s) for i, s in zip(idx.tolist(), dist.tolist()) if i >= 0 and s >= threshold]
+            return results
+
+        with self._stage("pack"):
+            combined_results = []
+            for i in range(len(queries)):
+                results = pack_single_result(distance[i], idx[i])
+                combined_results.append(results)
+        return combined_results
 
 if __name__=="__main__":
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s', datefmt='%m/%d/%Y %H:%M:%S',
+                        level=logging.INFO)
     example_sentences = [
         'An animal is biting a persons finger.',
         'A woman is reading.',
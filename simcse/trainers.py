@@ -1,4 +1,5 @@
 import collections
+import contextlib
 import inspect
 import math
 import sys
@@ -56,6 +57,7 @@ from torch.utils.data.dataloader import DataLoader
 from torch.utils.data.dataset import Dataset
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data.sampler import RandomSampler, SequentialSampler
+from torch.utils.checkpoint import get_device_states, set_device_states
 
 if is_torch_tpu_available():
     import torch_xla.core.xla_model as xm
@@ -75,6 +77,7 @@ if is_datasets_available():
 from transformers.trainer import _model_unwrap
 from transformers.optimization import Adafactor, AdamW, get_scheduler
 import copy
+from .models import cl_loss
 # Set path to SentEval
 PATH_TO_SENTEVAL = './SentEval'
 PATH_TO_DATA = './SentEval/data'
@@ -88,6 +91,25 @@ from filelock import FileLock
 
 logger = logging.get_logger(__name__)
 
+class _RandomState(object):
+    """
+    The CPU and CUDA random states when created; entering replays them, so that a second
+    forward pass draws the same dropout masks as the first.
+    """
+    def __init__(self, *tensors):
+        self.cpu_state = torch.get_rng_state()
+        self.devices, self.device_states = get_device_states(*tensors)
+
+    def __enter__(self):
+        self.fork = torch.random.fork_rng(devices=self.devices)
+        self.fork.__enter__()
+        torch.set_rng_state(self.cpu_state)
+        set_device_states(self.devices, self.device_states)
+
+    def __exit__(self, *args):
+        return self.fork.__exit__(*args)
+
+
 class CLTrainer(Trainer):
 
     def evaluate(
@@ -96,13 +118,20 @@ class CLTrainer(Trainer):
         ignore_keys: Optional[List[str]] = None,
         metric_key_prefix: str = "eval",
         eval_senteval_transfer: bool = False,
+        num_layers: Optional[int] = None,
     ) -> Dict[str, float]:
 
         # SentEval prepare and batcher
         def prepare(params, samples):
             return
 
+        # Time spent encoding, to report throughput next to the scores
+        encode_time = 0.0
+        num_encoded = 0
+
         def batcher(params, batch):
+            nonlocal encode_time, num_encoded
+            start = time.time()
             sentences = [' '.join(s) for s in batch]
             batch = self.tokenizer.batch_encode_plus(
                 sentences,
@@ -112,9 +141,14 @@ class CLTrainer(Trainer):
             for k in batch:
                 batch[k] = batch[k].to(self.args.device)
             with torch.no_grad():
-                outputs = self.model(**batch, output_hidden_states=True, return_dict=True, sent_emb=True)
+                # `num_layers` evaluates an early-exit (truncated) encoder
+                kwargs = {} if num_layers is None else {"num_layers": num_layers}
+                outputs = self.model(**batch, output_hidden_states=True, return_dict=True, sent_emb=True, **kwargs)
                 pooler_output = outputs.pooler_output
-            return pooler_output.cpu()
+            pooler_output = pooler_output.cpu()
+            encode_time += time.time() - start
+            num_encoded += len(sentences)
+            return pooler_output
 
         # Set params for SentEval (fastmode)
         params = {'task_path': PATH_TO_DATA, 'usepytorch': True, 'kfold': 5}
@@ -132,6 +166,7 @@ class CLTrainer(Trainer):
         sickr_spearman = results['SICKRelatedness']['dev']['spearman'][0]
 
         metrics = {"eval_stsb_spearman": stsb_spearman, "eval_sickr_spearman": sickr_spearman, "eval_avg_sts": (stsb_spearman + sickr_spearman) / 2} 
+        metrics["eval_sentences_per_second"] = num_encoded / encode_time if encode_time > 0 else 0.0
         if eval_senteval_transfer or self.args.eval_transfer:
             avg_transfer = 0
             for task in ['MR', 'CR', 'SUBJ', 'MPQA', 'SST2', 'TREC', 'MRPC']:
@@ -142,6 +177,75 @@ class CLTrainer(Trainer):
 
         self.log(metrics)
         return metrics
+
+    def training_step(self, model: nn.Module, inputs: Dict[str, Union[torch.Tensor, Any]]) -> torch.Tensor:
+        """
+        With `--grad_cache_chunk_size`, the contrastive loss is computed with gradient caching
+        (GradCache): representations are computed chunk by chunk without gradients, the loss and
+        its gradient w.r.t. the representations over the whole batch, and then each chunk is
+        encoded again (with the same dropout masks) to backpropagate the cached gradients.
+        Activation memory is bounded by the chunk size, not the batch size.
+        """
+        chunk_size = self.args.grad_cache_chunk_size
+        if chunk_size is None or inputs["input_ids"].size(0) <= chunk_size:
+            return super().training_step(model, inputs)
+        if self.args.n_gpu > 1 or self.deepspeed or self.use_apex:
+            raise ValueError("--grad_cache_chunk_size does not support DataParallel, deepspeed or apex.")
+
+        model.train()
+        inputs = self._prepare_inputs(inputs)
+        batch_size = inputs["input_ids"].size(0)
+        chunks = [{k: v[start:start + chunk_size] if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
+                  for start in range(0, batch_size, chunk_size)]
+        amp_context = autocast if self.use_amp else contextlib.nullcontext
+
+        # Representations of all chunks, without keeping activations (nor running the MLM head)
+        embeddings = []
+        random_states = []
+        with torch.no_grad():
+            for chunk in chunks:
+                random_states.append(_RandomState(chunk["input_ids"]))
+                with amp_context():
+                    output = model(**{k: v for k, v in chunk.items() if not k.startswith("mlm_")}, cl_embeddings=True)
+                embeddings.append(output.embeddings)
+
+        # Contrastive loss over the whole batch; its backward stops at the representations
+        embeddings = torch.cat(embeddings, 0).detach().requires_grad_()
+        with amp_context():
+            loss = cl_loss(self.model, embeddings)[0] / self.args.gradient_accumulation_steps
+        if self.use_amp:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+        # Encode each chunk again and backpropagate the cached gradients through the encoder;
+        # gradients are only synchronized across processes after the last chunk
+        mlm_loss = torch.zeros_like(loss)
+        cached = embeddings.detach().split(chunk_size)
+        for i, (chunk, random_state, grad) in enumerate(zip(chunks, random_states, embeddings.grad.split(chunk_size))):
+            no_sync = model.no_sync if self.args.local_rank != -1 and i < len(chunks) - 1 else contextlib.nullcontext
+            with no_sync(), random_state:
+                with amp_context():
+                    output = model(**chunk, cl_embeddings=True)
+                    # the cached gradients only apply if the replay reproduces the representations
+                    mismatch = (output.embeddings.detach() - cached[i]).abs().max().item()
+                    if mismatch > 1e-3 and not getattr(self, "_warned_grad_cache_mismatch", False):
+                        logger.warning("Gradient caching: the replayed representations differ from the first pass "
+                                       "by up to %.4f, so the cached gradients are inexact." % mismatch)
+                        self._warned_grad_cache_mismatch = True
+                    surrogate = (output.embeddings * grad).sum()
+                    # the MLM loss is a mean over masked tokens: weight each chunk by its share of them
+                    # (a chunk without masked tokens has a NaN mean and nothing to add)
+                    num_masked = (chunk["mlm_labels"] != -100).sum() if "mlm_labels" in chunk else 0
+                    if output.mlm_loss is not None and num_masked > 0:
+                        share = num_masked / (inputs["mlm_labels"] != -100).sum()
+                        chunk_mlm_loss = self.model.model_args.mlm_weight * output.mlm_loss * share
+                        chunk_mlm_loss = chunk_mlm_loss / self.args.gradient_accumulation_steps
+                        mlm_loss += chunk_mlm_loss.detach()
+                        surrogate = surrogate + (self.scaler.scale(chunk_mlm_loss) if self.use_amp else chunk_mlm_loss)
+                surrogate.backward()
+
+        return loss.detach() + mlm_loss
         
     def _save_checkpoint(self, model, trial, metrics=None):
         """
@@ -116,12 +116,37 @@ class ModelArguments:
             "help": "Weight for MLM auxiliary objective (only effective if --do_mlm)."
         }
     )
+    mlm_fused_forward: bool = field(
+        default=False,
+        metadata={
+            "help": "Encode the MLM inputs in the same encoder call as the contrastive inputs (only effective if --do_mlm; "
+            "not used with --grad_cache_chunk_size)."
+        }
+    )
+    mlm_masked_only: bool = field(
+        default=False,
+        metadata={
+            "help": "Only compute MLM predictions at masked positions (only effective if --do_mlm)."
+        }
+    )
     mlp_only_train: bool = field(
         default=False,
         metadata={
             "help": "Use MLP only during training"
         }
     )
+    queue_size: int = field(
+        default=0,
+        metadata={
+            "help": "Number of `z2` representations from previous steps kept as extra negatives (MoCo-style queue). 0 disables the queue."
+        }
+    )
+    queue_max_age: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Only use queued negatives from at most this many steps ago (only effective if --queue_size > 0)."
+        }
+    )
 
 
 @dataclass
@@ -195,6 +220,15 @@ class OurTrainingArguments(TrainingArguments):
         metadata={"help": "Evaluate transfer task dev sets (in validation)."}
     )
 
+    # Gradient caching
+    ## With --grad_cache_chunk_size, each batch is encoded in chunks of this many instances and the
+    ## contrastive loss is still computed over the whole batch, so the batch size (the number of
+    ## in-batch negatives) is not limited by activation memory.
+    grad_cache_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={"help": "Encode each batch in chunks of this many instances with gradient caching."}
+    )
+
     @cached_property
     @torch_required
     def _setup_devices(self) -> "torch.device":